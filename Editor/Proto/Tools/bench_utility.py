@@ -0,0 +1,277 @@
+#!/usr/bin/python
+
+# Benchmarks the file helpers of common.utility over a synthetic tree.
+#
+#   bench_utility.py [--files=100000] [--bundles=3] [--bundle-mb=2048] [--root=dir]
+#                    [--only=get_files,sync_folder] [--out=result.json] [--baseline=old.json] [--drop-caches]
+#
+# Every benchmark runs cold (in-process caches and sync/digest databases cleared, the page cache too
+# with --drop-caches) and then warm, in a forked process when possible so peak RSS is its own.
+
+from common import utility as u
+import json
+import os
+import random
+import sys
+import time
+
+TREE_VERSION = 1
+SMALL_PER_DIR = 100
+BLOCK_SIZE = 0x100000
+
+
+def make_tree(root, files, large, large_size):
+    params = {'version': TREE_VERSION, 'files': files, 'large': large, 'large_size': large_size}
+    manifest = u.join_path(root, 'tree.json')
+    if u.is_file(manifest) and json.loads(u.read(manifest)) == params:
+        u.info('Reusing tree => ' + root)
+        return
+
+    u.info('Generating tree => ' + root)
+    u.del_dir(root)
+    rand = random.Random(files)
+    block = os.urandom(BLOCK_SIZE)
+
+    for index in range(files):
+        path = u.join_path(root, 'small/d{:04d}/f{:06d}.txt'.format(index / SMALL_PER_DIR, index))
+        if index % SMALL_PER_DIR == 0:
+            os.makedirs(os.path.dirname(path))
+        offset = rand.randint(0, BLOCK_SIZE - 8192)
+        with open(path, 'wb') as file:
+            file.write(block[offset:offset + rand.randint(256, 8192)])
+
+    os.makedirs(u.join_path(root, 'bundles'))
+    for index in range(large):
+        with open(u.join_path(root, 'bundles/b{}.bundle'.format(index)), 'wb') as file:
+            for _ in range(large_size):
+                file.write(block)
+
+    with open(manifest, 'wb') as file:
+        file.write(json.dumps(params))
+
+
+def tree_size(files):
+    return sum(os.path.getsize(file) for file in files)
+
+
+def clear_caches(root, drop_caches):
+    u.clear_dir_index()
+    u.WRITE_DIGESTS.clear()
+    u.DIGEST_CACHE = None
+    u.DIGEST_CACHE_DIRTY = False
+    u.del_file(u.digest_cache_path())
+    for tree in ['small', 'synced', 'synced_db', 'zipped']:
+        u.del_file(u.sync_db_path(u.real_path(u.join_path(root, tree))))
+    if drop_caches:
+        u.execute('sync', ignore_error=True, verbose=False)
+        u.execute('echo 3 > /proc/sys/vm/drop_caches', ignore_error=True, verbose=False)
+
+
+# Each benchmark: setup(root, mode) returns the argument of run, run(arg) returns (files, bytes) processed
+def bench_get_files():
+    def run(root):
+        return len(u.get_files(u.join_path(root, 'small'))), 0
+    return None, run
+
+
+def bench_file_hash():
+    def setup(root, mode):
+        return u.get_files(u.join_path(root, 'small')) + u.get_files(u.join_path(root, 'bundles'))
+
+    def run(files):
+        u.file_hash(files)
+        return len(files), tree_size(files)
+    return setup, run
+
+
+def bench_files_hash():
+    setup, _ = bench_file_hash()
+
+    def run(files):
+        u.files_hash(files)
+        return len(files), tree_size(files)
+    return setup, run
+
+
+def bench_write():
+    def setup(root, mode):
+        if mode == 'cold':
+            u.del_dir(u.join_path(root, 'written'))
+        files = u.get_files(u.join_path(root, 'small'))
+        return [(u.join_path(root, 'written', u.rel_path(file, root)), u.read(file)) for file in files]
+
+    def run(contents):
+        for path, content in contents:
+            u.write(path, content)
+        return len(contents), sum(len(content) for _, content in contents)
+    return setup, run
+
+
+def bench_sync(hash_db):
+    def setup(root, mode):
+        paths = u.join_path(root, 'small'), u.join_path(root, 'synced_db' if hash_db else 'synced')
+        if mode == 'cold':
+            u.del_dir(paths[1])
+        return paths
+
+    def run(paths):
+        files = u.sync_folder(paths[0], paths[1], hash_db=hash_db)
+        return len(files), tree_size(files)
+    return setup, run
+
+
+def bench_zip_files():
+    def setup(root, mode):
+        path = u.join_path(root, 'zipped')
+        u.del_dir(path)
+        u.sync_folder(u.join_path(root, 'small'), path, hash_db=True)
+        return path
+
+    def run(path):
+        files = u.get_files(path)
+        u.zip_files(path, 32 * BLOCK_SIZE)
+        return len(files), tree_size(files)
+    return setup, run
+
+
+def bench_remove_empty_dirs():
+    def setup(root, mode):
+        path = u.join_path(root, 'empty')
+        for index in range(len(u.get_dirs(u.join_path(root, 'small')))):
+            folder = u.join_path(path, 'd{:04d}/a/b'.format(index))
+            if not os.path.isdir(folder):
+                os.makedirs(folder)
+        return path
+
+    def run(path):
+        count = len(u.get_dirs(path))
+        u.remove_empty_dirs(path)
+        return count, 0
+    return setup, run
+
+
+BENCHMARKS = [
+    ('get_files', bench_get_files),
+    ('file_hash', bench_file_hash),
+    ('files_hash', bench_files_hash),
+    ('write', bench_write),
+    ('sync_folder', lambda: bench_sync(False)),
+    ('sync_folder_db', lambda: bench_sync(True)),
+    ('zip_files', bench_zip_files),
+    ('remove_empty_dirs', bench_remove_empty_dirs),
+]
+
+
+def peak_rss_kb(who='self'):
+    """Peak RSS of this process, or of its largest waited-for child (pool workers), which is not added to it."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF if who == 'self' else resource.RUSAGE_CHILDREN).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak / 1024 if sys.platform == 'darwin' else peak
+
+
+def measure(name, factory, root, drop_caches):
+    setup, run = factory()
+    results = []
+    for mode in ['cold', 'warm']:
+        arg = setup(root, mode) if setup is not None else root
+        if mode == 'cold':
+            clear_caches(root, drop_caches)
+        start_time = time.time()
+        files, size = run(arg)
+        seconds = max(time.time() - start_time, 1e-6)
+        results.append({
+            'name': name,
+            'mode': mode,
+            'seconds': seconds,
+            'files': files,
+            'bytes': size,
+            'files_per_s': files / seconds,
+            'mb_per_s': size / seconds / BLOCK_SIZE,
+            'peak_rss_kb': peak_rss_kb(),
+            'peak_child_rss_kb': peak_rss_kb('children'),
+        })
+    return results
+
+
+def measure_isolated(name, factory, root, drop_caches):
+    if not hasattr(os, 'fork'):
+        return measure(name, factory, root, drop_caches)
+
+    # Buffered log lines would otherwise be written by both processes
+    u.flush_log()
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        code = 0
+        try:
+            output = json.dumps(measure(name, factory, root, drop_caches))
+        except BaseException as e:
+            output = json.dumps({'error': str(e)})
+            code = 1
+        u.log_rollup()
+        u.flush_log()
+        with os.fdopen(write_fd, 'wb') as pipe:
+            pipe.write(output)
+        os._exit(code)
+
+    os.close(write_fd)
+    with os.fdopen(read_fd, 'rb') as pipe:
+        output = json.loads(pipe.read() or '{}')
+    os.waitpid(pid, 0)
+    if isinstance(output, dict):
+        u.error('Benchmark failed => {}: {}'.format(name, output.get('error')))
+        return []
+    return output
+
+
+def report(results, baseline=None):
+    previous = dict(((r['name'], r['mode']), r) for r in (baseline or {}).get('results', []))
+    u.info('{:<20}{:<6}{:>10}{:>10}{:>12}{:>10}{:>12}{:>12}{:>10}'.format(
+        'benchmark', 'mode', 'seconds', 'files', 'files/s', 'MB/s', 'peak RSS', 'child RSS', 'vs base'))
+    for result in results:
+        old = previous.get((result['name'], result['mode']))
+        ratio = '{:.2f}x'.format(old['seconds'] / result['seconds']) if old is not None else '-'
+        u.info('{:<20}{:<6}{:>10.3f}{:>10}{:>12.0f}{:>10.1f}{:>12}{:>12}{:>10}'.format(
+            result['name'], result['mode'], result['seconds'], result['files'], result['files_per_s'],
+            result['mb_per_s'], u.readable((result['peak_rss_kb'] or 0) * 1024),
+            u.readable((result.get('peak_child_rss_kb') or 0) * 1024), ratio))
+
+
+def main():
+    files = int(u.get_argx('files', 100000))
+    large = int(u.get_argx('bundles', 3))
+    large_size = int(u.get_argx('bundle-mb', 2048))
+    root = u.get_argx('root', u.get_temp_path('bench_utility'))
+    only = u.get_argx('only')
+    out = u.get_argx('out', u.get_temp_path('bench_utility_{}.json'.format(time.strftime('%Y%m%d_%H%M%S'))))
+    baseline_path = u.get_argx('baseline')
+    drop_caches = u.get_argx('drop-caches') is not None
+
+    make_tree(root, files, large, large_size)
+
+    results = []
+    for name, factory in BENCHMARKS:
+        if only is None or name in only.split(','):
+            u.info('=> Benchmark: ' + name, True)
+            results += measure_isolated(name, factory, root, drop_caches)
+
+    baseline = json.loads(u.read(baseline_path)) if baseline_path is not None else None
+    report(results, baseline)
+
+    u.write(out, json.dumps({
+        'time': time.time(),
+        'platform': sys.platform,
+        'python': sys.version.split()[0],
+        'params': {'files': files, 'large': large, 'large_size': large_size, 'root': root},
+        'results': results,
+    }, indent=4, sort_keys=True))
+    u.info('Results => ' + out)
+
+
+if __name__ == '__main__':
+    main()
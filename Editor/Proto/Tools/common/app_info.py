@@ -1,4 +1,39 @@
 from common import utility as u
+import json
+import os
+import re
+import time
+
+ARCHIVE_CACHE_VERSION = 1
+PATCH_FOLDER_PATTERN = re.compile(r'^(\d+)_(\d+)$')
+# patch root => (mtime, {to: [(from, folder)] sorted by from})
+PATCH_INDEX = {}
+
+
+def patch_index(root):
+    """from_to patch folders under root by their to patch, rebuilt only when root's mtime changes."""
+    if not u.is_dir(root):
+        return {}
+
+    mtime = os.stat(root).st_mtime
+    cached = PATCH_INDEX.get(root)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    index = {}
+    for name, _ in u.list_dir(root)[1]:
+        match = PATCH_FOLDER_PATTERN.match(name)
+        if match is not None:
+            from_patch, to_patch = int(match.group(1)), int(match.group(2))
+            # A patch that does not move forward would never end the chain
+            if from_patch < to_patch:
+                index.setdefault(to_patch, []).append((from_patch, u.join_path(root, name)))
+    for candidates in index.values():
+        candidates.sort()
+
+    if time.time() - mtime > u.DIR_INDEX_RACY_SECONDS:
+        PATCH_INDEX[root] = (mtime, index)
+    return index
 
 
 class AppInfo:
@@ -20,9 +55,34 @@ class AppInfo:
         return ('{}/depot/' + u.proj_name.lower() + '/{}/{}/{}').format(mount_point, self.platform, self.job_name, self.svn_revision)
 
     def archive(self, mount_point):
-        candidates = [f for f in u.get_files(self.archive_root(mount_point), self.archive_ext()) if u.base_name(f).startswith(self.archive_prefix())]
+        root = u.real_path(self.archive_root(mount_point))
+        if not u.is_dir(root):
+            return None
+
+        exts = self.archive_ext()
+        prefix = self.archive_prefix()
+        candidates = sorted(name for name in self.archive_listing(root)
+                            if name[0] != '.' and name.startswith(prefix) and u.ext_name(name) in exts)
         if len(candidates) > 0:
-            return candidates[0]
+            return os.path.join(root, candidates[0])
+
+    def archive_listing(self, root):
+        """File names directly in root, kept on disk per (platform, job_name, svn_revision) until root's mtime changes."""
+        cache_path = u.get_temp_path('archive_cache/{}_{}_{}.json'.format(self.platform, self.job_name, self.svn_revision))
+        mtime = os.stat(root).st_mtime
+
+        if u.is_file(cache_path):
+            try:
+                cache = json.loads(u.read(cache_path))
+                if cache.get('version') == ARCHIVE_CACHE_VERSION and cache.get('root') == root and cache.get('mtime') == mtime:
+                    return cache['files']
+            except ValueError:
+                u.warning('Invalid archive cache => ' + cache_path)
+
+        files = u.list_dir(root)[0]
+        if time.time() - mtime > u.DIR_INDEX_RACY_SECONDS:
+            u.write(cache_path, json.dumps({'version': ARCHIVE_CACHE_VERSION, 'root': root, 'mtime': mtime, 'files': files}))
+        return files
 
     def patch_root(self, mount_point):
         return ('{}/clientupdate/{}/{}/{}.{}').format(mount_point, 
@@ -32,18 +92,32 @@ class AppInfo:
         self.app_revision)
 
     def patches(self, mount_point):
-        all_patch_folders = u.get_dirs(self.patch_root(mount_point))
         patch_files = []
+        for folder in self.patch_chain(mount_point):
+            patch_files += u.get_files(u.join_path(folder, self.platform), ['zip'], recursive=False)
+        return patch_files
+
+    def patch_chain(self, mount_point):
+        """Patch folders leading from the base package to app_patch, oldest first."""
+        root = self.patch_root(mount_point)
+        chain = []
         iter_patch = self.app_patch
+        if iter_patch <= 0:
+            return chain
+
+        index = patch_index(root)
         while iter_patch > 0:
-            suffix = '_{}'.format(iter_patch)
-            for folder in all_patch_folders:
-                if folder.endswith(suffix):
-                    patch_files = u.get_files(u.join_path(folder, self.platform), ['zip'], recursive=False) + patch_files
-                    iter_patch = int(u.base_name(folder).split('_')[0])
-                    break
+            candidates = index.get(iter_patch)
+            if not candidates:
+                u.error('Broken patch chain => no patch to {} in {}'.format(iter_patch, root))
+                u.abort()
+            # The lowest from is the largest step, so the shortest chain
+            from_patch, folder = candidates[0]
+            chain.append(folder)
+            iter_patch = from_patch
 
-        return patch_files
+        chain.reverse()
+        return chain
 
     def next_patch(self, mount_point, to_patch):
         return ('{}/{}_{}/{}').format(self.patch_root(mount_point), self.app_patch, to_patch, self.platform)
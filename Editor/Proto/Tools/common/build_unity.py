@@ -3,13 +3,15 @@ from res import patchlize_resource
 from res import patchlize_dlc
 from res import append_resource_hash
 from common import log_filter
+from common.job_graph import JobGraph, tree_fingerprint
 
 unity_log = u.get_temp_path('unity_build' + u.get_env('JOB_NAME', '') + '.log')
 
-def execute_unity(method, ext_args=None):
+def execute_unity(method, ext_args=None, log_path=None):
     unity_bin = '/Applications/Unity/Hub/Editor/2019.3.11f1/Unity.app/Contents/MacOS/Unity'
     proj = u.get_res('..')
     platform = u.get_env('SCRIPT_PLATFORM', '').lower()
+    log_path = log_path or unity_log
 
     buildTarget = {
         'android': 'Android',
@@ -18,46 +20,80 @@ def execute_unity(method, ext_args=None):
         'win': 'Win64'
     }[platform]
 
-    args = ''
+    args = []
     if ext_args is not None:
         for key in ext_args:
-            args += '{0} {1} '.format(key, ext_args[key])
-    log_filter.start(unity_log)
-    result = u.execute(unity_bin,
-                        '-batchmode',
-                        '-quit',
-                        '-projectPath', proj,
-                        '-executeMethod', 'NOAH.Build.ContinuousIntegration.' + method,
-                        '-buildTarget', buildTarget, # platform.lower(),
-                        '-nographics',
-                        '-logFile', unity_log,
-                        args,
-                        ignore_error=True).code
-    log_filter.stop()
-    return result
+            args += [key, ext_args[key]]
+    process = u.Process([unity_bin,
+                         '-batchmode',
+                         '-quit',
+                         '-projectPath', proj,
+                         '-executeMethod', 'NOAH.Build.ContinuousIntegration.' + method,
+                         '-buildTarget', buildTarget, # platform.lower(),
+                         '-nographics',
+                         '-logFile', log_path] + args)
 
+    # Every Unity run has its own monitor, a crash or hang only stops the run that caused it
+    monitor = log_filter.watch(log_filter.LogMonitor(log_path, kill=process.cancel))
+    u.info('=> Unity: ' + method, True)
+    result = process.start().wait()
+    u.info('<= Finished: {0} {1:.2f} seconds code: {2}'.format(method, result.elapsed, result.code), True)
+    if log_filter.unwatch(monitor) != 0 and result.code == 0:
+        return monitor.error_code
+    return result.code
+
+
+def run_module(module):
+    u.execute_module(module)
+    return 0
+
+
+def exclude_resource(path):
+    filename = u.base_name(path)
+    return filename in ['AssetBundle.manifest', 'buildlog.txt', 'buildlogtep.json']
+
+
+def sync_resource():
+    u.sync_folder(u.get_unity_output('AssetBundle'), u.get_unity_output('AssetBundle_Repacked'), exclude_predicate=exclude_resource, hash_db=True)
 
-def rebuild_all():
-    error_code = rebuild_resource()
-    if error_code == 0:
-        error_code = execute_unity('BuildCode')
 
-    return error_code
+def add_resource_stages(graph, retry=0):
+    """Returns the name of the last resource stage."""
+    graph.add('BuildResource', lambda: execute_unity('BuildResource'), retry=retry)
+    graph.add('SyncResource', sync_resource, ['BuildResource'],
+              fingerprint=lambda: tree_fingerprint(u.get_unity_output('AssetBundle'), u.get_unity_output('AssetBundle_Repacked')))
+    graph.add('AppendResourceHash', lambda: run_module(append_resource_hash), ['SyncResource'])
+    if u.get_env('SCRIPT_CONFIG_DLCCLIENT') is not None:
+        graph.add('Patchlize', lambda: run_module(patchlize_dlc), ['AppendResourceHash'])
+    elif u.get_env('SCRIPT_CONFIG_TINYCLIENT') is not None:
+        graph.add('Patchlize', lambda: run_module(patchlize_resource), ['AppendResourceHash'])
+    else:
+        return 'AppendResourceHash'
+    return 'Patchlize'
+
+
+def make_graph(cmd, retry=0):
+    graph = JobGraph('build_unity_' + cmd)
+    if cmd == 'RecreateRolePrefab':
+        graph.add('RecreateRoleSprites', lambda: execute_unity('RecreateRoleSprites'), retry=retry)
+        graph.add('RecreateRolePrefab', lambda: execute_unity('RecreateRolePrefab'), ['RecreateRoleSprites'], retry=retry)
+    elif cmd == 'RebuildAll':
+        # The player packs the repacked and hashed resources, so it waits for the whole resource chain
+        last_stage = add_resource_stages(graph, retry)
+        graph.add('BuildCode', lambda: execute_unity('BuildCode'), [last_stage], retry=retry)
+    elif cmd == 'RebuildResource':
+        add_resource_stages(graph, retry)
+    elif cmd == 'RefreshUIAtlas':
+        graph.add('RefreshUIAtlas', lambda: execute_unity('RefreshUIAtlas'), retry=retry)
+    return graph
+
+
+def rebuild_all():
+    return make_graph('RebuildAll').run()
 
 
 def rebuild_resource():
-    error_code = execute_unity('BuildResource')
-    if error_code == 0:
-        def exclude(path):
-            filename = u.base_name(path)
-            return filename in ['AssetBundle.manifest', 'buildlog.txt', 'buildlogtep.json']
-        u.sync_folder(u.get_unity_output('AssetBundle'), u.get_unity_output('AssetBundle_Repacked'), exclude_predicate=exclude)
-        u.execute_module(append_resource_hash)
-        if u.get_env('SCRIPT_CONFIG_DLCCLIENT') is not None:
-            u.execute_module(patchlize_dlc)
-        elif u.get_env('SCRIPT_CONFIG_TINYCLIENT') is not None:
-            u.execute_module(patchlize_resource)
-    return error_code
+    return make_graph('RebuildResource').run()
 
 def refresh_uiatlas():
     return execute_unity('RefreshUIAtlas')
@@ -68,23 +104,8 @@ def main(cmd, retry=0):
         if u.get_env('SCRIPT_CLEANBUILD') is not None:
             u.clear_dir(u.get_unity_output(''))
 
-        error_code = 0
-
-        while True:
-            if cmd == 'RecreateRolePrefab':
-                error_code = execute_unity('RecreateRoleSprites')
-                error_code = execute_unity('RecreateRolePrefab')
-            elif cmd == 'RebuildAll':
-                error_code = rebuild_all()
-            elif cmd == 'RebuildResource':
-                error_code = rebuild_resource()
-            elif cmd == 'RefreshUIAtlas':
-                error_code = refresh_uiatlas()
-            
-            if error_code == 0 or retry <= 0:
-                break
-            else:
-                retry = retry - 1
+        # Each stage retries on its own, stages that already succeeded are not rerun
+        error_code = make_graph(cmd, retry).run()
 
         if error_code != 0:
             u.log(u.read(unity_log))
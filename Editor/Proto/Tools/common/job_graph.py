@@ -0,0 +1,135 @@
+from common import utility as u
+import Queue
+import hashlib
+import json
+import os
+import threading
+import time
+
+
+def tree_fingerprint(*paths):
+    hasher = hashlib.new('sha1')
+    for path in paths:
+        hasher.update(path)
+        for file in u.get_files(path):
+            stat = os.stat(file)
+            hasher.update('{}:{}:{}'.format(u.rel_path(file, path), stat.st_size, stat.st_mtime))
+    return hasher.hexdigest()
+
+
+class Job:
+    def __init__(self, name, func, deps=None, fingerprint=None, retry=0):
+        self.name = name
+        self.func = func
+        self.deps = deps or []
+        self.fingerprint = fingerprint
+        self.retry = retry
+
+
+class JobGraph:
+    """Runs stages as a DAG: independent stages concurrently, failed stages retried on their own.
+
+    A stage succeeds when its func returns None or 0. A stage with a fingerprint callable is
+    skipped when its fingerprint matches the one taken right after its last success, so stages
+    that change their own inputs (a sync into its destination) are fingerprinted as they left them."""
+
+    def __init__(self, name, cache_path=None):
+        self.name = name
+        self.jobs = {}
+        self.order = []
+        self.cache_path = cache_path or u.get_temp_path('job_cache_' + name + '.json')
+        self.cache = {}
+        self.lock = threading.Lock()
+
+        if u.is_file(self.cache_path):
+            try:
+                self.cache = json.loads(u.read(self.cache_path))
+            except ValueError:
+                u.warning('Invalid job cache => ' + self.cache_path)
+
+    def add(self, name, func, deps=None, fingerprint=None, retry=0):
+        self.jobs[name] = Job(name, func, deps, fingerprint, retry)
+        self.order.append(name)
+        return self.jobs[name]
+
+    def invalidate(self, name=None):
+        with self.lock:
+            if name is None:
+                self.cache.clear()
+            else:
+                self.cache.pop(name, None)
+            u.write(self.cache_path, json.dumps(self.cache, indent=4, sort_keys=True))
+
+    def execute_job(self, job, results):
+        code = -1
+        try:
+            key = job.fingerprint() if job.fingerprint is not None else None
+            if key is not None and self.cache.get(job.name) == key:
+                u.info('Stage cached => ' + job.name)
+                code = 0
+            else:
+                for attempt in range(job.retry + 1):
+                    if attempt > 0:
+                        u.warning('Stage retry {}/{} => {}'.format(attempt, job.retry, job.name))
+                    u.info('=> Stage: ' + job.name, True)
+                    start_time = time.time()
+                    with u.profile_span('stage', 'stage', job.name):
+                        code = job.func() or 0
+                    u.info('<= Finished: {0} {1:.2f} seconds code: {2}'.format(job.name, time.time() - start_time, code), True)
+                    if code == 0:
+                        break
+
+                if code == 0 and key is not None:
+                    key = job.fingerprint()
+                    with self.lock:
+                        self.cache[job.name] = key
+                        u.write(self.cache_path, json.dumps(self.cache, indent=4, sort_keys=True))
+        except BaseException as e:
+            # u.abort raises SystemExit, which would otherwise silently end the stage thread
+            u.error('Stage failed => {}: {}'.format(job.name, e))
+            code = -1
+        finally:
+            results.put((job.name, code))
+
+    def run(self, threads=0):
+        """Returns 0 when every stage succeeded, otherwise the code of the first failed stage."""
+        pending = list(self.order)
+        codes = {}
+        results = Queue.Queue()
+        running = 0
+        limit = threads or len(self.jobs)
+
+        while len(pending) > 0 or running > 0:
+            for name in list(pending):
+                job = self.jobs[name]
+                if any(codes.get(dep, 0) != 0 for dep in job.deps):
+                    u.warning('Stage skipped => ' + name)
+                    codes[name] = -1
+                    pending.remove(name)
+                elif running < limit and all(dep in codes for dep in job.deps):
+                    pending.remove(name)
+                    worker = threading.Thread(target=self.execute_job, args=(job, results))
+                    worker.daemon = True
+                    worker.start()
+                    running += 1
+
+            if running == 0:
+                if len(pending) > 0:
+                    u.error('Stages with unknown or cyclic dependencies => ' + ', '.join(pending))
+                    return -1
+                break
+
+            # Poll with a timeout so KeyboardInterrupt still reaches the main thread
+            while True:
+                try:
+                    name, code = results.get(True, 0xFFFF)
+                    break
+                except Queue.Empty:
+                    pass
+            running -= 1
+            codes[name] = code
+
+        for name in self.order:
+            if codes.get(name, 0) != 0:
+                return codes[name]
+        return 0
@@ -1,40 +1,143 @@
 from common import utility as u
 import sys
-from select import select
+import ctypes
+import ctypes.util
+import io
+import json
+import re
+import select
+import threading
 import time
-import thread
 import os
 
 def halt(message=None):
     if message:
         u.error(message)
-    u.execute('killall', 'Unity')
+    # No Unity left running is not a failure of the job being halted
+    u.execute('killall', 'Unity', ignore_error=True)
 
-is_monitoring = False
-monitor_path = None
 HALT_TIMEOUT = 3600 #seconds
-time_out = HALT_TIMEOUT
-error_code = 0
+POLL_INTERVAL = 0.25 #seconds
+monitor = None
+loop = None
 
-def start(path):
-    global is_monitoring,monitor_path
-    if is_monitoring:
-        u.warning("logfilter is monitoring at [%s]"%(monitor_path))
-    is_monitoring = True
-    monitor_path = path
-    try:
-        thread.start_new_thread(monitor_impl,(monitor_path,))
-    except Exception as e:
-        u.error("Error: unable to start thread:%s"%(e))
-        u.abort()
-
-def monitor_impl(path):
-    global time_out,error_code
-    error_code = 0
-    time_out = HALT_TIMEOUT
-    
+# action 'crash' halts Unity, 'reset' restarts the hang timeout, anything else is only counted.
+# Extra rules are read from the json list at SCRIPT_LOG_FILTER_RULES, 'regex' marks raw patterns.
+DEFAULT_RULES = [
+    {'name': 'null_exception', 'pattern': 'Receiving unhandled NULL exception', 'action': 'crash'},
+    {'name': 'bug_reporter', 'pattern': 'Launching bug reporter', 'action': 'crash'},
+    {'name': 'batchmode_abort', 'pattern': 'Aborting batchmode due to failure', 'action': 'crash'},
+    {'name': 'assertion_failed', 'pattern': 'Assertion failed on expression', 'action': 'crash'},
+    {'name': 'build_resource_begin', 'pattern': '=== Build Resource Begin ===', 'action': 'reset'},
+    {'name': 'build_player_begin', 'pattern': '=== Build Player Begin ===', 'action': 'reset'},
+]
+
+
+def load_rules(path=None):
+    rules = list(DEFAULT_RULES)
+    path = path or u.get_env('SCRIPT_LOG_FILTER_RULES', None)
+    if path is not None:
+        try:
+            rules += json.loads(u.read(path))
+        except ValueError as e:
+            u.warning('logfilter: invalid rules [%s]: %s' % (path, e))
+    return rules
+
+
+class LogEvent:
+    def __init__(self, name, action, line, line_no):
+        self.name = name
+        self.action = action
+        self.line = line
+        self.line_no = line_no
+
+
+class LogMatcher:
+    """All rule patterns compiled into one alternation, so every line is scanned once."""
+
+    def __init__(self, rules=None):
+        self.rules = load_rules() if rules is None else rules
+        self.counters = dict((rule['name'], 0) for rule in self.rules)
+        self.line_no = 0
+        self.pattern = re.compile('|'.join(
+            '(?P<r{}>{})'.format(i, rule['pattern'] if rule.get('regex') else re.escape(rule['pattern']))
+            for i, rule in enumerate(self.rules)))
+
+    def match(self, line):
+        self.line_no += 1
+        events = []
+        for found in self.pattern.finditer(line):
+            rule = self.rules[int(found.lastgroup[1:])]
+            self.counters[rule['name']] += 1
+            events.append(LogEvent(rule['name'], rule.get('action'), line, self.line_no))
+        return events
+
+    def summary(self):
+        return ', '.join('{}: {}'.format(name, count) for name, count in sorted(self.counters.items()) if count > 0)
+
+
+class PollWatcher:
+    def add(self, path):
+        pass
+
+    def wait(self, timeout):
+        time.sleep(max(0, min(timeout, POLL_INTERVAL)))
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher:
+    IN_MODIFY = 0x00000002
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_NONBLOCK = 0x00000800
+    IN_CLOEXEC = 0x00080000
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.folders = set()
+
+    def add(self, path):
+        # The directory is watched, so rotated, truncated or recreated logs wake us up as well
+        folder = os.path.dirname(os.path.abspath(path))
+        if folder in self.folders:
+            return
+        mask = self.IN_MODIFY | self.IN_CLOSE_WRITE | self.IN_MOVED_FROM | self.IN_MOVED_TO | self.IN_CREATE | self.IN_DELETE
+        if self.libc.inotify_add_watch(self.fd, folder, mask) < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_add_watch failed')
+        self.folders.add(folder)
+
+    def wait(self, timeout):
+        readable, _, _ = select.select([self.fd], [], [], max(0, timeout))
+        if len(readable) > 0:
+            try:
+                os.read(self.fd, 0x10000)
+            except OSError:
+                pass
+
+    def close(self):
+        os.close(self.fd)
+
+
+def make_watcher():
+    if sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher()
+        except (OSError, AttributeError, TypeError) as e:
+            u.warning('logfilter: inotify unavailable (%s), polling' % (e))
+    return PollWatcher()
+
+
+def touch_log(path):
     if not os.path.isfile(path):
-        
+
         u.info('touching file at [%s]'%(path))
         basedir = os.path.dirname(path)
         if basedir not in ['',' ','/']:
@@ -43,48 +146,208 @@ def monitor_impl(path):
         with open(path, 'a'):
             os.utime(path, None)
             u.info("logfilter: new logfile was touched in [%s]"%(path))
-    u.info("logfilter starting tracking:%s"%(path))
-    tracking_file = open(path,"r")
-    loglines = follow(tracking_file)
-    for line in loglines:
-        for error_msg in ['Receiving unhandled NULL exception', 
-        'Launching bug reporter',
-        'Aborting batchmode due to failure',
-        "Assertion failed on expression"]:
-            if error_msg in line:
-                halt("Unity crashed or failed")
-                error_code = -1
-                break
-        if '=== Build Resource Begin ===' in line:
-            time_out = HALT_TIMEOUT
-        if '=== Build Player Begin ===' in line:
-            time_out = HALT_TIMEOUT
-    if error_code != 0:
-        u.abort()
 
-def stop():
-    global is_monitoring
-    is_monitoring = False
-
-def follow(thefile):
-    global is_monitoring,error_code
-    thefile.seek(0,2)
-    waiting_time = 0 #second
-    while True:
-        if not is_monitoring:
-            break
-        line = thefile.readline()
-        if not line:
-            if waiting_time >= time_out:
-                halt("Unity hanged for a long time %s seconds"%(waiting_time))
-                error_code = -2
+
+class LogMonitor:
+    """State of one watched log: its own rules, hang timeout and exit status.
+
+    Lines are read from offset (the end of the log by default) and the log is followed across
+    rotation and truncation. kill stops the job behind the log, every Unity by default."""
+
+    def __init__(self, path, timeout=HALT_TIMEOUT, rules=None, kill=None, offset=None):
+        self.path = path
+        self.timeout = timeout
+        self.matcher = LogMatcher(rules)
+        self.kill = kill
+        self.offset = offset
+        self.error_code = 0
+        self.halted = False
+        self.tracking_file = None
+        self.pending = ''
+        self.last_activity = time.time()
+
+    def open(self):
+        touch_log(self.path)
+        u.info("logfilter starting tracking:%s"%(self.path))
+        self.tracking_file = io.open(self.path, 'rb')
+        if self.offset is None:
+            self.tracking_file.seek(0, 2)
+        else:
+            self.tracking_file.seek(self.offset)
+        self.last_activity = time.time()
+
+    def close(self):
+        if self.tracking_file is not None:
+            self.tracking_file.close()
+            self.tracking_file = None
+
+    def halt(self, message, error_code):
+        # The job is stopped once, the first reason is the one reported
+        if self.halted:
+            return
+        self.halted = True
+        if self.error_code == 0:
+            self.error_code = error_code
+        if self.kill is None:
+            halt(message)
+        else:
+            u.error(message)
+            self.kill()
+
+    def reset_timeout(self, timeout=None):
+        if timeout is not None:
+            self.timeout = timeout
+        self.last_activity = time.time()
+
+    def on_line(self, line):
+        actions = set(event.action for event in self.matcher.match(line))
+        if 'crash' in actions:
+            self.halt("Unity crashed or failed [%s]"%(self.path), -1)
+        if 'reset' in actions:
+            self.reset_timeout()
+
+    def poll(self, max_reads=16):
+        """Handles what was appended since the last poll, returns True while more may be pending."""
+        for _ in range(max_reads):
+            data = self.tracking_file.read(0x10000)
+            if not data:
                 break
-            waiting_time += 5
-            time.sleep(5)
-            continue
+            self.last_activity = time.time()
+            lines = (self.pending + data).split('\n')
+            self.pending = lines.pop()
+            for line in lines:
+                self.on_line(line + '\n')
         else:
-            waiting_time = 0
-        yield line
+            return True
+
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return False
+        if stat.st_ino != os.fstat(self.tracking_file.fileno()).st_ino:
+            u.info("logfilter: log rotated [%s]"%(self.path))
+            self.tracking_file.close()
+            self.tracking_file = io.open(self.path, 'rb')
+            self.pending = ''
+            return True
+        if stat.st_size < self.tracking_file.tell():
+            u.info("logfilter: log truncated [%s]"%(self.path))
+            self.tracking_file.seek(0)
+            self.pending = ''
+            return True
+        return False
+
+    def remaining(self, now):
+        return self.timeout - (now - self.last_activity)
+
+    def check_timeout(self, now):
+        idle = now - self.last_activity
+        if idle < self.timeout:
+            return False
+        self.halt("Unity hanged for a long time %d seconds [%s]"%(idle, self.path), -2)
+        return True
+
+
+class MonitorLoop(threading.Thread):
+    """One thread and one watcher servicing every registered LogMonitor.
+
+    A monitor leaves the loop when it is removed, once it halted its job or when it fails,
+    one broken log or kill never stops the others from being watched."""
+
+    def __init__(self):
+        threading.Thread.__init__(self, name='logfilter')
+        self.daemon = True
+        self.monitors = []
+        self.lock = threading.Lock()
+        self.watcher = make_watcher()
+        self.stopped = threading.Event()
+
+    def add(self, log_monitor):
+        with self.lock:
+            log_monitor.open()
+            try:
+                self.watcher.add(log_monitor.path)
+            except OSError as e:
+                u.warning('logfilter: cannot watch [%s] (%s), polling' % (log_monitor.path, e))
+                self.watcher.close()
+                self.watcher = PollWatcher()
+            self.monitors.append(log_monitor)
+
+    def remove(self, log_monitor):
+        with self.lock:
+            if log_monitor in self.monitors:
+                self.monitors.remove(log_monitor)
+                log_monitor.close()
+
+    def stop(self):
+        self.stopped.set()
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join()
+
+    def run(self):
+        try:
+            while not self.stopped.is_set():
+                busy = False
+                wait_time = 1.0
+                now = time.time()
+                with self.lock:
+                    for log_monitor in list(self.monitors):
+                        try:
+                            busy = log_monitor.poll() or busy
+                            done = log_monitor.halted or log_monitor.check_timeout(now)
+                        except Exception as e:
+                            u.warning('logfilter: stopped watching [%s]: %s' % (log_monitor.path, e))
+                            done = True
+                        if done:
+                            self.monitors.remove(log_monitor)
+                            log_monitor.close()
+                        else:
+                            wait_time = min(wait_time, log_monitor.remaining(now))
+                    watcher = self.watcher
+
+                if not busy:
+                    watcher.wait(wait_time)
+        finally:
+            with self.lock:
+                for log_monitor in self.monitors:
+                    log_monitor.close()
+                self.monitors = []
+                self.watcher.close()
+
+
+def watch(log_monitor):
+    global loop
+    if loop is None or not loop.is_alive():
+        loop = MonitorLoop()
+        loop.start()
+    loop.add(log_monitor)
+    return log_monitor
+
+
+def unwatch(log_monitor):
+    if loop is not None:
+        loop.remove(log_monitor)
+    if len(log_monitor.matcher.summary()) > 0:
+        u.info('logfilter [%s]: %s' % (log_monitor.path, log_monitor.matcher.summary()))
+    return log_monitor.error_code
+
+
+def start(path):
+    global monitor
+    if monitor is not None:
+        u.warning("logfilter is monitoring at [%s]"%(monitor.path))
+        unwatch(monitor)
+
+    touch_log(path)
+    monitor = watch(LogMonitor(path, offset=os.path.getsize(path)))
+
+def stop():
+    global monitor
+    if monitor is None:
+        return 0
+    error_code = unwatch(monitor)
+    monitor = None
+    return error_code
 
 def test():
     log_path = "log/test.log"
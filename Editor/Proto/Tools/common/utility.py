@@ -6,6 +6,7 @@ import multiprocessing
 import os
 import re
 import shutil
+import signal
 import subprocess
 import sys
 import time
@@ -16,6 +17,14 @@ import ctypes
 import codecs
 import string
 import math
+import mmap
+import tempfile
+import atexit
+import collections
+import contextlib
+import functools
+import itertools
+import threading
 # import inspect
 
 try:
@@ -23,29 +32,96 @@ try:
 except ImportError:
     proj_name = 'NOAH'
 
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
 original_env = None
 
 
+# Compiled SuperFormatter templates, the least recently used quarter is dropped once full
+TEMPLATE_CACHE = {}
+TEMPLATE_USES = {}
+TEMPLATE_CACHE_SIZE = 1024
+TEMPLATE_CLOCK = itertools.count()
+TEMPLATE_CACHE_LOCK = threading.Lock()
+
+
 class SuperFormatter(string.Formatter):
     """World's simplest Template engine."""
 
+    def compile(self, template, cache=True):
+        """Parses template once into (literal, field, spec, spec_is_plain, conversion) ops, field being (first, rest)."""
+        ops = TEMPLATE_CACHE.get(template) if cache else None
+        if ops is None:
+            ops = []
+            for literal, field_name, spec, conversion in self.parse(template):
+                field = None
+                if field_name is not None:
+                    first, rest = field_name._formatter_field_name_split()
+                    field = (first, tuple(rest))
+                ops.append((literal, field, spec, spec is not None and '{' not in spec and '}' not in spec, conversion))
+            ops = tuple(ops)
+            if not cache:
+                return ops
+
+            with TEMPLATE_CACHE_LOCK:
+                TEMPLATE_CACHE[template] = ops
+                if len(TEMPLATE_CACHE) > TEMPLATE_CACHE_SIZE:
+                    for key in sorted(TEMPLATE_USES, key=TEMPLATE_USES.get)[:TEMPLATE_CACHE_SIZE / 4]:
+                        TEMPLATE_CACHE.pop(key, None)
+                        TEMPLATE_USES.pop(key, None)
+        TEMPLATE_USES[template] = next(TEMPLATE_CLOCK)
+        return ops
+
+    def vformat(self, format_string, args, kwargs, cache=True):
+        used_args = set()
+        result = self.render(self.compile(format_string, cache), args, kwargs, used_args, 2)
+        self.check_unused_args(used_args, args, kwargs)
+        return result
+
+    def render(self, ops, args, kwargs, used_args, recursion_depth):
+        # string.Formatter._vformat over compiled ops, with get_field and plain format_field inlined
+        if recursion_depth < 0:
+            raise ValueError('Max string recursion exceeded')
+        result = []
+        append = result.append
+        for literal, field, spec, spec_is_plain, conversion in ops:
+            if literal:
+                append(literal)
+            if field is not None:
+                first, rest = field
+                obj = args[first] if isinstance(first, (int, long)) else kwargs[first]
+                for is_attr, key in rest:
+                    obj = getattr(obj, key) if is_attr else obj[key]
+                used_args.add(first)
+                if conversion is not None:
+                    obj = self.convert_field(obj, conversion)
+                if not spec_is_plain or recursion_depth < 1:
+                    spec = self.render(self.compile(spec), args, kwargs, used_args, recursion_depth - 1)
+                append(format(obj, '') if len(spec) == 0 else self.format_field(obj, spec))
+        return ''.join(result)
+
     def format_field(self, value, spec):
         if spec.startswith('repeat'):
             template = spec.partition(':')[-1]
-            # print 'template is', template, spec.partition('|')
-            def sub_str(iv):
-                # print 'sub_str', template, iv, iv.name, iv.need_setter
-                return self.format(template, item=iv)
-            ret_temp = ''.join(sub_str(i) for i in value)
-            return self.format(ret_temp,item=value)
+            ret_temp = ''.join(self.vformat(template, (), {'item': iv}) for iv in value)
+            # Formatting again only changes anything when the items produced braces,
+            # the expanded text is rarely seen twice so it is not cached
+            if '{' not in ret_temp and '}' not in ret_temp:
+                return ret_temp
+            return self.vformat(ret_temp, (), {'item': value}, False)
         elif spec == 'call':
             return value()
         elif spec.startswith('?'):
-            # print 'condition', value, spec[2:].partition('|')
             return spec[2:].partition('|')[0 if value else -1]
         else:
             return super(SuperFormatter, self).format_field(value, spec)
-            
+
 
 def initialize(script_path):
     global original_env
@@ -206,13 +282,30 @@ def is_patch_mode():
 
 # Log
 LOG_LEVEL = None
+LOG_LEVEL_VERBOSE = -2
 LOG_LEVEL_NORMAL = 0
 LOG_LEVEL_INFO = 1
 LOG_LEVEL_WARNING = 2
 LOG_LEVEL_ERROR = 3
 LOG_LEVEL_SUCCESS = 4
 LOG_LEVEL_NONE = 99
-LOG_INDENT = 0
+LOG_LEVEL_NAMES = {LOG_LEVEL_VERBOSE: 'verbose', LOG_LEVEL_NORMAL: 'normal', LOG_LEVEL_INFO: 'info',
+                   LOG_LEVEL_WARNING: 'warning', LOG_LEVEL_ERROR: 'error', LOG_LEVEL_SUCCESS: 'success'}
+# level: (prefix, color code)
+LOG_STYLES = {LOG_LEVEL_INFO: ('', 34), LOG_LEVEL_WARNING: ('warning: ', 33),
+              LOG_LEVEL_ERROR: ('error: ', 31), LOG_LEVEL_SUCCESS: ('success: ', 32)}
+LOG_BUFFER_LINES = 64
+LOG_BUFFER_SECONDS = 0.5
+# Resolved once by log_setup: terminal colors, json lines target, buffered lines and rolled up counts
+LOG_FORMAT = None
+LOG_BUFFER = []
+LOG_FLUSH_TIME = 0
+# Process owning LOG_BUFFER, a forked child drops the lines it inherited instead of writing them again
+LOG_PID = os.getpid()
+LOG_ROLLUP = collections.OrderedDict()
+LOG_LOCK = threading.RLock()
+# Indent is kept per thread, so concurrent jobs do not shift each other's output
+LOG_STATE = threading.local()
 
 
 def color_message(message, color_code, bold=False):
@@ -222,44 +315,104 @@ def color_message(message, color_code, bold=False):
     return result
 
 
-def log(message, level=LOG_LEVEL_NORMAL, noident=False, bold=False):
-    global LOG_INDENT, LOG_LEVEL
+def log_setup():
+    """SCRIPT_LOG_LEVEL picks the level, SCRIPT_LOG_JSON writes json lines: '1' instead of text, a path besides it."""
+    global LOG_LEVEL, LOG_FORMAT
 
-    original_message = message
+    with LOG_LOCK:
+        if LOG_FORMAT is None:
+            if LOG_LEVEL is None:
+                LOG_LEVEL = int(get_env('SCRIPT_LOG_LEVEL', -1))
 
-    if LOG_LEVEL is None:
-        LOG_LEVEL = int(get_env('SCRIPT_LOG_LEVEL', -1))
+            json_target = get_env('SCRIPT_LOG_JSON')
+            LOG_FORMAT = {
+                'term': get_env('TERM') is not None or get_env('USER') == '91act',
+                'json': json_target == '1',
+                'json_file': open(json_target, 'a') if json_target not in [None, '', '0', '1'] else None,
+            }
+            LOG_FORMAT['text'] = not LOG_FORMAT['json']
+            atexit.register(flush_log)
+            atexit.register(log_rollup)
+
+            flusher = threading.Thread(target=log_flusher, name='log_flusher')
+            flusher.daemon = True
+            flusher.start()
+    return LOG_FORMAT
+
+
+def log_flusher():
+    # Lines logged right before long silent work, such as a subprocess, still show up in time
+    while True:
+        time.sleep(LOG_BUFFER_SECONDS)
+        if len(LOG_BUFFER) > 0:
+            flush_log()
 
-    if level >= LOG_LEVEL:
-        is_term = get_env('TERM') is not None or get_env('USER') == '91act'
 
-        if level == LOG_LEVEL_INFO:
-            if is_term:
-                message = color_message(message, 34, bold)
+def own_log_buffer():
+    # Called before taking LOG_LOCK: a child forked while another thread held it gets a fresh lock
+    global LOG_PID, LOG_LOCK
 
-        if level == LOG_LEVEL_WARNING:
-            message = 'warning: ' + message
-            if is_term:
-                message = color_message(message, 33, bold)
+    if LOG_PID != os.getpid():
+        LOG_LOCK = threading.RLock()
+        del LOG_BUFFER[:]
+        LOG_PID = os.getpid()
 
-        if level == LOG_LEVEL_ERROR:
-            message = 'error: ' + message
-            if is_term:
-                message = color_message(message, 31, bold)
 
-        if level == LOG_LEVEL_SUCCESS:
-            message = 'success: ' + message
-            if is_term:
-                message = color_message(message, 32, bold)
+def log_indent(delta=0):
+    LOG_STATE.indent = getattr(LOG_STATE, 'indent', 0) + delta
+    return LOG_STATE.indent
 
-        if is_term:
-            message = message.replace('=>', '➜').replace('<=', '✔')
 
-        message += '\n'
+def flush_log():
+    global LOG_FLUSH_TIME
 
-        pipe = sys.stdout if level == LOG_LEVEL_NORMAL else sys.stderr
+    own_log_buffer()
+    with LOG_LOCK:
+        lines = list(LOG_BUFFER)
+        del LOG_BUFFER[:]
+        LOG_FLUSH_TIME = time.time()
+        for pipe, text in lines:
+            pipe.write(text)
+        sys.stdout.flush()
+        sys.stderr.flush()
+        if LOG_FORMAT is not None and LOG_FORMAT['json_file'] is not None:
+            LOG_FORMAT['json_file'].flush()
 
-        pipe.write(('' if noident else ('  ' * LOG_INDENT)) + message)
+
+def log(message, level=LOG_LEVEL_NORMAL, noident=False, bold=False):
+    original_message = message
+    log_format = LOG_FORMAT or log_setup()
+
+    if level >= LOG_LEVEL:
+        indent = 0 if noident else getattr(LOG_STATE, 'indent', 0)
+        pipe = sys.stdout if level <= LOG_LEVEL_NORMAL else sys.stderr
+        own_log_buffer()
+
+        if log_format['json'] or log_format['json_file'] is not None:
+            record = json.dumps({'time': time.time(), 'level': LOG_LEVEL_NAMES.get(level, str(level)),
+                                 'indent': indent, 'thread': threading.current_thread().name,
+                                 'message': original_message if isinstance(original_message, unicode)
+                                 else original_message.decode('utf-8', 'replace')}) + '\n'
+            if log_format['json']:
+                text = record
+            else:
+                with LOG_LOCK:
+                    log_format['json_file'].write(record)
+
+        if log_format['text']:
+            prefix, color = LOG_STYLES.get(level, ('', None))
+            message = prefix + message
+            if log_format['term']:
+                if color is not None:
+                    message = color_message(message, color, bold)
+                message = message.replace('=>', '➜').replace('<=', '✔')
+            text = '  ' * indent + message + '\n'
+
+        with LOG_LOCK:
+            LOG_BUFFER.append((pipe, text))
+            if level >= LOG_LEVEL_WARNING or len(LOG_BUFFER) >= LOG_BUFFER_LINES or \
+                    time.time() - LOG_FLUSH_TIME > LOG_BUFFER_SECONDS:
+                flush_log()
 
     return original_message
 
@@ -278,6 +431,138 @@ def error(message, bold=False):
     return log(message, LOG_LEVEL_ERROR, False, bold)
 
 
+def detail(message, summary):
+    """Per-file messages: logged at LOG_LEVEL_VERBOSE, otherwise only counted and reported by log_rollup as summary."""
+    if LOG_FORMAT is None:
+        log_setup()
+    if LOG_LEVEL <= LOG_LEVEL_VERBOSE:
+        return log(message, LOG_LEVEL_INFO)
+
+    own_log_buffer()
+    with LOG_LOCK:
+        LOG_ROLLUP[summary] = LOG_ROLLUP.get(summary, 0) + 1
+    return message
+
+
+def log_rollup():
+    own_log_buffer()
+    with LOG_LOCK:
+        counts = list(LOG_ROLLUP.items())
+        LOG_ROLLUP.clear()
+    for summary, count in counts:
+        info('{} => {} {}'.format(summary, count, 'item' if count == 1 else 'items'))
+
+
+# Profile
+# SCRIPT_PROFILE=1 records calls, wall time, bytes and files per utility function and reports them at exit,
+# with a chrome://tracing timeline of stages and subprocesses saved to the temp folder (or to SCRIPT_PROFILE if a path).
+PROFILE = None
+PROFILE_TARGET = None
+PROFILE_STATS = {}
+PROFILE_EVENTS = []
+PROFILE_STATE = threading.local()
+
+
+def profile_setup():
+    global PROFILE, PROFILE_TARGET
+
+    with LOG_LOCK:
+        if PROFILE is None:
+            PROFILE_TARGET = get_env('SCRIPT_PROFILE', None)
+            PROFILE = PROFILE_TARGET not in [None, '0']
+            if PROFILE:
+                atexit.register(profile_report)
+    return PROFILE
+
+
+def profile_frames():
+    frames = getattr(PROFILE_STATE, 'frames', None)
+    if frames is None:
+        frames = PROFILE_STATE.frames = []
+    return frames
+
+
+def profile_count(bytes_read=0, bytes_written=0, files=0):
+    """Adds to every function being profiled on this thread, so the numbers are inclusive like the times."""
+    if PROFILE:
+        for frame in profile_frames():
+            frame[1] += bytes_read
+            frame[2] += bytes_written
+            frame[3] += files
+
+
+def profile_record(name, start_time, elapsed, category=None, label=None, counts=(0, 0, 0), nested=False):
+    own_log_buffer()
+    with LOG_LOCK:
+        stats = PROFILE_STATS.setdefault(name, [0, 0.0, 0, 0, 0])
+        stats[0] += 1
+        # Recursive calls are already inside the time of the outermost one
+        if not nested:
+            stats[1] += elapsed
+            stats[2] += counts[0]
+            stats[3] += counts[1]
+            stats[4] += counts[2]
+        if category is not None:
+            PROFILE_EVENTS.append((label or name, category, start_time, elapsed,
+                                   threading.current_thread().ident))
+
+
+@contextlib.contextmanager
+def profile_span(name, category=None, label=None):
+    if PROFILE is None:
+        profile_setup()
+    if not PROFILE:
+        yield
+        return
+
+    frames = profile_frames()
+    nested = any(frame[0] == name for frame in frames)
+    frame = [name, 0, 0, 0]
+    frames.append(frame)
+    start_time = time.time()
+    try:
+        yield
+    finally:
+        frames.remove(frame)
+        profile_record(name, start_time, time.time() - start_time, category, label, frame[1:], nested)
+
+
+def profiled(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if PROFILE is None:
+            profile_setup()
+        if not PROFILE:
+            return func(*args, **kwargs)
+        with profile_span(func.__name__):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def profile_report():
+    global PROFILE
+
+    PROFILE = False
+    with LOG_LOCK:
+        stats = sorted(PROFILE_STATS.items(), key=lambda item: -item[1][1])
+        events = list(PROFILE_EVENTS)
+
+    info('Profile => {:<24}{:>10}{:>12}{:>14}{:>14}{:>10}'.format('function', 'calls', 'seconds', 'read', 'written', 'files'))
+    for name, (calls, seconds, bytes_read, bytes_written, files) in stats:
+        info('Profile => {:<24}{:>10}{:>12.3f}{:>14}{:>14}{:>10}'.format(
+            name, calls, seconds, readable(bytes_read), readable(bytes_written), files))
+
+    start_time = min([event[2] for event in events] or [0])
+    trace = {'displayTimeUnit': 'ms', 'traceEvents': [
+        {'name': label, 'cat': category, 'ph': 'X', 'pid': os.getpid(), 'tid': tid,
+         'ts': int((begin - start_time) * 1000000), 'dur': int(elapsed * 1000000)}
+        for label, category, begin, elapsed, tid in events]}
+    trace_path = PROFILE_TARGET if PROFILE_TARGET != '1' else get_temp_path('profile_trace_{}.json'.format(os.getpid()))
+    write(trace_path, json.dumps(trace))
+    info('Profile trace => ' + trace_path)
+    flush_log()
+
+
 # Shell
 def get_val(dict, key, default=None):
     if key in dict:
@@ -306,11 +591,14 @@ class ExecuteResult:
         self.out = None
         self.error = None
         self.exception = None
+        self.cmd = None
+        self.start_time = 0
+        self.elapsed = 0
+        self.timed_out = False
+        self.cancelled = False
 
 
 def execute(script, *cmd_args, **args):
-    global LOG_INDENT
-
     ignore_error = get_val(args, 'ignore_error', False)
     verbose = get_val(args, 'verbose', True)
     work_dir = get_val(args, 'work_dir', None)
@@ -319,11 +607,7 @@ def execute(script, *cmd_args, **args):
     cmd_args = list(cmd_args) + get_val(args, 'args', [])
 
     result = ExecuteResult()
-    LOG_INDENT += 1
-
-    current_dir = os.getcwd()
-    if work_dir is not None:
-        os.chdir(work_dir)
+    log_indent(1)
 
     shell = ''
     if script.endswith('.sh'):
@@ -349,8 +633,10 @@ def execute(script, *cmd_args, **args):
     set_env('__SCRIPT_ERROR', None)
     start_time = time.time()
 
-    pipes = subprocess.Popen(cmd_line, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env, shell=True)
-    result.out, result.error = pipes.communicate()
+    flush_log()
+    with profile_span('execute', 'subprocess', cmd_line):
+        pipes = subprocess.Popen(cmd_line, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env, shell=True, cwd=work_dir)
+        result.out, result.error = pipes.communicate()
     if result.out is not None:
         result.out = result.out.strip()
     if result.error is not None:
@@ -366,25 +652,196 @@ def execute(script, *cmd_args, **args):
                 error('Command failed: ' + cmd_line + ' code: ' + str(result.code) + ' message: ' + result.error, True)
             abort()
 
-    if work_dir is not None:
-        os.chdir(current_dir)
+    log_indent(-1)
+    return result
+
 
-    LOG_INDENT -= 1
+RUNNING_PROCESSES = set()
+RUNNING_PROCESSES_HOOKED = False
+
+
+def hook_running_processes():
+    global RUNNING_PROCESSES_HOOKED
+    RUNNING_PROCESSES_HOOKED = True
+    atexit.register(stop_running_processes)
+
+
+def stop_running_processes():
+    for process in list(RUNNING_PROCESSES):
+        process.stop()
+
+
+class Process:
+    """Runs an argv list without a shell, streaming its output to the log line by line.
+
+    Only the last tail_lines lines are kept unless capture is set, so long runs stay in bounded memory.
+    The child leads its own process group, cancel stops everything it spawned along with it."""
+
+    def __init__(self, argv, cwd=None, env=None, timeout=None, verbose=True, capture=False, tail_lines=200):
+        argv = [str(arg) for arg in argv]
+        if argv[0].endswith('.sh'):
+            argv = ['bash'] + argv
+        elif argv[0].endswith('.py'):
+            argv = [sys.executable] + argv
+
+        self.argv = argv
+        self.cwd = cwd
+        self.env = env
+        self.timeout = timeout
+        self.verbose = verbose
+        self.capture = capture
+        self.tail_lines = tail_lines
+        self.pipes = None
+        self.readers = []
+        self.timer = None
+        self.grace = None
+        self.exited = threading.Event()
+        self.result = ExecuteResult()
+        self.result.cmd = ' '.join(argv)
+
+    def start(self):
+        flush_log()
+        self.result.start_time = time.time()
+        if is_win():
+            group = {'creationflags': subprocess.CREATE_NEW_PROCESS_GROUP}
+        else:
+            group = {'preexec_fn': os.setsid}
+        self.pipes = subprocess.Popen(self.argv, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                      cwd=self.cwd, env=self.env, bufsize=1, **group)
+        # Its own group no longer gets the terminal's Ctrl-C, so whatever is left is stopped at exit
+        if not RUNNING_PROCESSES_HOOKED:
+            hook_running_processes()
+        RUNNING_PROCESSES.add(self)
+        self.out_lines = [] if self.capture else collections.deque(maxlen=self.tail_lines)
+        self.error_lines = [] if self.capture else collections.deque(maxlen=self.tail_lines)
+        for pipe, lines in [(self.pipes.stdout, self.out_lines), (self.pipes.stderr, self.error_lines)]:
+            reader = threading.Thread(target=self.read_lines, args=(pipe, lines))
+            reader.daemon = True
+            reader.start()
+            self.readers.append(reader)
+
+        if self.timeout is not None:
+            self.timer = threading.Timer(self.timeout, self.expire)
+            self.timer.daemon = True
+            self.timer.start()
+        return self
+
+    def read_lines(self, pipe, lines):
+        for line in iter(pipe.readline, ''):
+            lines.append(line)
+            if self.verbose:
+                log(line.rstrip('\r\n'))
+        pipe.close()
+
+    def expire(self):
+        self.result.timed_out = True
+        warning('Timed out after {} seconds => {}'.format(self.timeout, self.result.cmd))
+        self.cancel()
+
+    def signal_group(self, force):
+        if is_win():
+            argv = ['taskkill', '/T', '/PID', str(self.pipes.pid)] + (['/F'] if force else [])
+            with open(os.devnull, 'wb') as null:
+                subprocess.call(argv, stdout=null, stderr=null)
+        else:
+            os.killpg(self.pipes.pid, signal.SIGKILL if force else signal.SIGTERM)
+
+    def cancel(self, grace=5):
+        """Stops the group from another thread, the child is only reaped by the thread in wait."""
+        if self.pipes is not None and not self.exited.is_set():
+            self.result.cancelled = True
+            self.grace = grace
+            try:
+                self.signal_group(False)
+                self.exited.wait(grace)
+                # Children that outlived the leader are killed too, they would keep the pipes open
+                self.signal_group(True)
+            except OSError:
+                pass
+
+    def stop(self, grace=5):
+        """cancel for the thread that would otherwise wait: nobody else reaps the child here."""
+        if self.pipes is not None and not self.exited.is_set():
+            self.result.cancelled = True
+            self.grace = grace
+            try:
+                self.signal_group(False)
+                deadline = time.time() + grace
+                while self.pipes.poll() is None and time.time() < deadline:
+                    time.sleep(0.05)
+                self.signal_group(True)
+            except OSError:
+                pass
+            self.pipes.wait()
+            self.exited.set()
+        RUNNING_PROCESSES.discard(self)
+
+    def wait(self):
+        try:
+            self.pipes.wait()
+        except BaseException:
+            self.stop()
+            raise
+        self.exited.set()
+        RUNNING_PROCESSES.discard(self)
+        # A cancelled run's pipes may still be held by a child that left the group
+        deadline = time.time() + self.grace if self.result.cancelled else None
+        for reader in self.readers:
+            reader.join(max(deadline - time.time(), 0) if deadline is not None else None)
+        if self.timer is not None:
+            self.timer.cancel()
+
+        self.result.code = self.pipes.returncode
+        if self.result.code == 0 and (self.result.cancelled or self.result.timed_out):
+            # The child may still exit cleanly on SIGTERM, a stopped run is never a success
+            self.result.code = -signal.SIGTERM
+        self.result.out = ''.join(self.out_lines).strip()
+        self.result.error = ''.join(self.error_lines).strip()
+        self.result.elapsed = time.time() - self.result.start_time
+        if profile_setup():
+            profile_record('run', self.result.start_time, self.result.elapsed, 'subprocess', self.result.cmd)
+        return self.result
+
+
+def run(argv, ignore_error=False, verbose=True, **args):
+    """execute for argv lists: no shell, cwd instead of chdir, streamed output and an optional timeout."""
+    log_indent(1)
+    process = Process(argv, verbose=verbose, **args)
+    if verbose:
+        info('=> Run: ' + process.result.cmd, True)
+
+    set_env('__SCRIPT_ERROR', None)
+    result = process.start().wait()
+
+    if verbose:
+        info('<= Finished: {0} {1:.2f} seconds'.format(base_name(process.argv[0]), result.elapsed), True)
+
+    if result.code != 0 and not ignore_error:
+        if verbose:
+            error('Command failed: ' + result.cmd + ' code: ' + str(result.code) + ' message: ' + result.error, True)
+        abort()
+
+    log_indent(-1)
     return result
 
 
-def execute_module(module, *args):
-    global LOG_INDENT
+def run_many(commands, threads=0, **args):
+    """Runs argv lists concurrently, returns their ExecuteResult (code, out, error, elapsed) in order."""
+    return parallel_simple(lambda argv: Process(argv, **args).start().wait(), commands, threads, 'thread', chunksize=1)
+
 
-    LOG_INDENT += 1
+def execute_module(module, *args):
+    log_indent(1)
 
     info('=> Module: ' + module.__name__, True)
     set_env('__SCRIPT_ERROR', None)
     start_time = time.time()
-    result = apply(module.main, args)
+    with profile_span('execute_module', 'module', module.__name__):
+        result = apply(module.main, args)
+    log_rollup()
     info('<= Finished: {0} {1:.2f} seconds'.format(module.__name__, time.time() - start_time), True)
 
-    LOG_INDENT -= 1
+    log_indent(-1)
 
     return result
 
@@ -557,6 +1014,66 @@ def dir_name(path, resolve=True):
         return os.path.dirname(path)
 
 
+# Directory listings keyed by real path => (mtime, [file names], [(dir name, is link)])
+DIR_INDEX = {}
+# Listings younger than this may still change within the same mtime tick, so they are never cached
+DIR_INDEX_RACY_SECONDS = 2
+
+
+def clear_dir_index():
+    DIR_INDEX.clear()
+
+
+def list_dir(path):
+    mtime = os.stat(path).st_mtime
+    cached = DIR_INDEX.get(path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1], cached[2]
+
+    files = []
+    dirs = []
+    if scandir is not None:
+        for entry in scandir(path):
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            if is_dir:
+                dirs.append((entry.name, entry.is_symlink()))
+            else:
+                files.append(entry.name)
+    else:
+        for name in os.listdir(path):
+            full_path = os.path.join(path, name)
+            if os.path.isdir(full_path):
+                dirs.append((name, os.path.islink(full_path)))
+            else:
+                files.append(name)
+
+    if time.time() - mtime > DIR_INDEX_RACY_SECONDS:
+        DIR_INDEX[path] = (mtime, files, dirs)
+    return files, dirs
+
+
+def walk_files(path, follow_links=False, recursive=True):
+    pending = [path]
+    while len(pending) > 0:
+        root = pending.pop()
+        try:
+            files, dirs = list_dir(root)
+        except OSError:
+            continue
+
+        for file in files:
+            if '~$' not in file:
+                yield root, file
+
+        if recursive:
+            for name, is_link in dirs:
+                if (follow_links or not is_link) and name != '.svn' and '~$' not in name:
+                    pending.append(os.path.join(root, name))
+
+
 def internal_get_files(path, exts=None, follow_links=True, recursive=True, ignore_hidden=True):
     result = []
 
@@ -570,58 +1087,48 @@ def internal_get_files(path, exts=None, follow_links=True, recursive=True, ignor
     if is_file(path):
         result = [path]
     else:
-        entries = os.walk(path, followlinks=follow_links)
+        for root, file in walk_files(real_path(path), follow_links, recursive):
+            is_matched = not ignore_hidden or file[0] != '.'
 
-        if not recursive:
-            try:
-                entries = [next(entries)]
-            except:
-                entries = None
-
-        if entries is not None:
-            for root, dirs, files in entries:
-                for file in files:
-                    full_path = join_path(root, file)
-                    is_matched = '/.svn/' not in full_path
-                    is_matched = is_matched and '~$' not in full_path
-                    is_matched = is_matched and (not ignore_hidden or file[0] != '.')
-
-                    if is_matched:
-                        this_ext = ext_name(file)
-                        if len(include_exts) > 0: is_matched = this_ext in include_exts
-                        if len(exclude_exts) > 0: is_matched = this_ext not in exclude_exts
-
-                    if is_matched:
-                        result.append(full_path)
+            if is_matched:
+                this_ext = ext_name(file)
+                if len(include_exts) > 0: is_matched = this_ext in include_exts
+                if len(exclude_exts) > 0: is_matched = this_ext not in exclude_exts
+
+            if is_matched:
+                result.append(os.path.join(root, file))
 
     return result
 
 
+@profiled
 def get_files(base_path, exts=None,
               follow_links=False,
               recursive=True,
               ignore_hidden=True,
               alt_path=None,
               prefer_alt=False):
-    alt_path = join_path(base_path, alt_path)
-
     base_result = internal_get_files(base_path, exts, follow_links, recursive, ignore_hidden)
     alt_result = []
 
-    if alt_path is not None and alt_path != base_path:
-        alt_result = internal_get_files(alt_path, exts, follow_links, recursive, ignore_hidden)
+    real_base_path = real_path(base_path)
+    if alt_path is not None:
+        alt_path = join_path(base_path, alt_path)
+        if alt_path != real_base_path:
+            alt_result = internal_get_files(alt_path, exts, follow_links, recursive, ignore_hidden)
 
-    merge_result = base_result
+    merge_result = set(base_result)
 
     for alt_file in alt_result:
-        base_file = join_path(base_path, base_name(alt_file))
+        base_file = os.path.join(real_base_path, base_name(alt_file))
 
         if base_file in merge_result:
             merge_result.remove(base_file)
-            merge_result.append(alt_file)
+            merge_result.add(alt_file)
         elif prefer_alt:
-            merge_result.append(alt_file)
+            merge_result.add(alt_file)
 
+    profile_count(files=len(merge_result))
     return sorted(merge_result)
 
 
@@ -685,7 +1192,7 @@ def unlink(link):
     else:
         if os.path.islink(link):
             os.unlink(link)
-            info('Unlinked => ' + link)
+            detail('Unlinked => ' + link, 'Unlinked')
 
 
 def link(src, dst, override=False):
@@ -718,13 +1225,13 @@ def link(src, dst, override=False):
                 os.unlink(dst)
             else:
                 os.remove(dst)
-            info('Linked overrided => ' + dst)
+            detail('Linked overrided => ' + dst, 'Linked overrided')
         
         if not os.path.exists(dst):
             if src != dst:
                 mkdir_for_file(dst)
                 os.symlink(src, dst)
-                info('Linked => ' + dst)
+                detail('Linked => ' + dst, 'Linked')
             else:                
                 warning("Link Skip => Try to link file with the same path: " + src)
         else:       
@@ -734,7 +1241,7 @@ def link(src, dst, override=False):
 def del_file(file):
     if is_file(file):
         os.remove(file)
-        info('Removed => ' + file)
+        detail('Removed => ' + file, 'Removed')
 
 
 def del_files(files):
@@ -748,7 +1255,7 @@ def mkdir(folder):
             os.makedirs(folder)
         except:
             pass
-        info('Made folder => ' + folder)
+        detail('Made folder => ' + folder, 'Made folder')
 
 
 def mkdir_for_file(file):
@@ -796,16 +1303,19 @@ def touch(path):
     mkdir_for_file(path)
     with open(path, 'a'):
         os.utime(path, None)
-        info('Touched => ' + path)
+        detail('Touched => ' + path, 'Touched')
 
 
+@profiled
 def copy(src_path, dst_path):
     if os.path.exists(src_path):
         mkdir_for_file(dst_path)
         try:
             shutil.copy(src_path, dst_path)
             shutil.copystat(src_path, dst_path)
-            info('Copied => ' + dst_path)
+            if PROFILE:
+                profile_count(bytes_written=os.path.getsize(dst_path), files=1)
+            detail('Copied => ' + dst_path, 'Copied')
         except:
             warning('Copystat failed => ' + dst_path)
 
@@ -822,7 +1332,7 @@ def copytree(src_path, dst_path):
 def move(src_path, dst_path):
     if os.path.exists(src_path) and not os.path.exists(dst_path):
         shutil.move(src_path, dst_path)
-        info('Moved => ' + dst_path)
+        detail('Moved => ' + dst_path, 'Moved')
 
 def compare_mtime_impl(src, dst):
     return os.path.getmtime(src) - os.path.getmtime(dst) > 1
@@ -838,38 +1348,167 @@ def compare_mtime(dst_file, src_files):
     return result
 
 
+WRITE_DIGESTS = {}
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+
+def stat_key(path):
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime, stat.st_ino
+
+
+def content_digest(content):
+    return hashlib.sha1(content).hexdigest()
+
+
+def is_content_changed(path, content, chunk_size=0x100000):
+    # Size first, then the digest remembered for this exact stat, and the bytes only as a last resort
+    key = stat_key(path)
+    if key[0] != len(content):
+        return True
+
+    cached = WRITE_DIGESTS.get(path)
+    if cached is not None and cached[0] == key:
+        return cached[1] != content_digest(content)
+
+    with open(path, 'rb') as file:
+        for start in range(0, len(content), chunk_size):
+            if file.read(chunk_size) != content[start:start + chunk_size]:
+                return True
+
+    WRITE_DIGESTS[path] = (key, content_digest(content))
+    return False
+
+
+def is_digest_changed(path, size, digest):
+    """is_content_changed for content that is only known by size and sha1, the old file is hashed only without a cached digest."""
+    key = stat_key(path)
+    if key[0] != size:
+        return True
+
+    cached = WRITE_DIGESTS.get(path)
+    if cached is not None and cached[0] == key:
+        return cached[1] != digest
+    return file_digest(path) != digest
+
+
+def make_temp_file(path):
+    """A temp file beside the file path resolves to, so commit_file can rename it over that file."""
+    path = os.path.realpath(path)
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.' + base_name(path) + '.')
+    if exists(path):
+        shutil.copymode(path, temp_path)
+    else:
+        os.chmod(temp_path, 0666 & ~UMASK)
+    return fd, temp_path
+
+
+@profiled
 def write(path, content, force=False):
+    if isinstance(content, unicode):
+        content = content.encode('utf-8')
+
+    # A symlink is written through, its target is replaced and the link kept
+    path = os.path.realpath(path)
     need_update = force or not exists(path)
     if not need_update:
-        with open(path, 'rb') as file:
-            need_update = file.read() != content
+        need_update = is_content_changed(path, content)
 
     if need_update:
         mkdir_for_file(path)
-    
-        file_attr = 0
-        FILE_ATTRIBUTE_HIDDEN = 0x02
-        FILE_ATTRIBUTE_READONLY = 0x01
-        attr_mask = FILE_ATTRIBUTE_HIDDEN | FILE_ATTRIBUTE_READONLY
 
-        if is_win() and exists(path):
-            file_attr = ctypes.windll.kernel32.GetFileAttributesA(path)
-            ctypes.windll.kernel32.SetFileAttributesA(path, file_attr & ~attr_mask)
+        # Write aside and rename over, so readers never see a partially written file
+        fd, temp_path = make_temp_file(path)
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                file.write(content)
+        except:
+            os.remove(temp_path)
+            raise
+        commit_file(temp_path, path, content_digest(content))
+        profile_count(bytes_written=len(content), files=1)
 
-        with open(path, 'wb') as file:
-            file.write(content)
+    return need_update
 
-        if is_win() and file_attr > 0:
-            ctypes.windll.kernel32.SetFileAttributesA(path, file_attr)
 
-    return need_update
+def commit_file(temp_path, path, digest):
+    """Renames a finished temp file from make_temp_file over the file path resolves to and remembers its digest."""
+    path = os.path.realpath(path)
+    file_attr = 0
+    FILE_ATTRIBUTE_HIDDEN = 0x02
+    FILE_ATTRIBUTE_READONLY = 0x01
+    attr_mask = FILE_ATTRIBUTE_HIDDEN | FILE_ATTRIBUTE_READONLY
 
+    if is_win() and exists(path):
+        file_attr = ctypes.windll.kernel32.GetFileAttributesA(path)
+        ctypes.windll.kernel32.SetFileAttributesA(path, file_attr & ~attr_mask)
 
+    try:
+        replace_file(temp_path, path)
+    except:
+        if exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+    if is_win() and file_attr > 0:
+        ctypes.windll.kernel32.SetFileAttributesA(path, file_attr)
+
+    WRITE_DIGESTS[path] = (stat_key(path), digest)
+
+
+def replace_file(src_path, dst_path):
+    if is_win():
+        MOVEFILE_REPLACE_EXISTING = 0x01
+        if not ctypes.windll.kernel32.MoveFileExW(unicode(src_path), unicode(dst_path), MOVEFILE_REPLACE_EXISTING):
+            raise ctypes.WinError()
+    else:
+        os.rename(src_path, dst_path)
+
+
+@profiled
+def replace_in_file(path, old, new, chunk_size=0x100000):
+    """Streams path into a sibling temp file with old replaced by new, then renames it over path.
+
+    Files without a match are only scanned, never rewritten. Returns whether path changed."""
+    if len(old) == 0 or file_size(path) == 0:
+        return False
+
+    path = os.path.realpath(path)
+    with open(path, 'rb') as file:
+        data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        profile_count(bytes_read=len(data), files=1)
+        try:
+            pos = data.find(old)
+            if pos < 0:
+                return False
+
+            fd, temp_path = make_temp_file(path)
+            with os.fdopen(fd, 'wb') as output:
+                start = 0
+                while start < len(data):
+                    end = pos if pos >= 0 else len(data)
+                    for chunk_start in range(start, end, chunk_size):
+                        output.write(data[chunk_start:min(chunk_start + chunk_size, end)])
+                    if pos < 0:
+                        break
+                    output.write(new)
+                    start = pos + len(old)
+                    pos = data.find(old, start)
+        finally:
+            data.close()
+
+    replace_file(temp_path, path)
+    return True
+
+
+@profiled
 def read(path, skip_bom=False):
     result = ''
     if exists(path):
         with open(path, 'rb') as file:
             result = file.read().replace('\r', '')
+        profile_count(bytes_read=len(result), files=1)
     else:
         warning("Failed when try to read [%s] "%(path))
     if skip_bom:
@@ -934,6 +1573,7 @@ def sync_folder_symbol(src_path, dst_path,
     return src_files
 
 
+@profiled
 def sync_folder(src_path, dst_path,
                 src_files=None,
                 remove_diff=True,
@@ -941,7 +1581,10 @@ def sync_folder(src_path, dst_path,
                 diff_predicate=None,
                 exclude_predicate=None,
                 exts=None,
-                remove_original=False):
+                remove_original=False,
+                hash_db=False,
+                threads=0,
+                link_mode='reflink'):
     src_path = real_path(src_path)
 
     dst_path = real_path(dst_path)
@@ -953,6 +1596,9 @@ def sync_folder(src_path, dst_path,
     if exclude_predicate is not None:
         src_files = [file for file in src_files if not exclude_predicate(file)]
 
+    if hash_db:
+        return sync_folder_db(src_path, dst_path, src_files, remove_diff, diff_predicate, remove_original, threads, link_mode)
+
     if remove_diff:
         dst_files = get_files(dst_path)
         for file in dst_files:
@@ -984,50 +1630,383 @@ def sync_folder(src_path, dst_path,
         else:
             warning('Not found => ' + file)
 
+    log_rollup()
     return src_files
 
 
-def file_hash(files):
+# Content addressed sync
+SYNC_DB_VERSION = 1
+FICLONE = 0x40049409
+
+
+def sync_db_path(tree):
+    return get_temp_path('sync_db/' + hashlib.sha1(tree).hexdigest() + '.json')
+
+
+def load_sync_db(tree):
+    path = sync_db_path(tree)
+    if is_file(path):
+        try:
+            db = json.loads(read(path))
+            if db.get('version') == SYNC_DB_VERSION:
+                return db['files']
+        except (ValueError, KeyError):
+            warning('Invalid sync database => ' + path)
+    return {}
+
+
+def save_sync_db(tree, files):
+    write(sync_db_path(tree), json.dumps({'version': SYNC_DB_VERSION, 'tree': tree, 'files': files}))
+
+
+def tree_state(tree, rel_files, db, threads=0):
+    """Maps rel path => [size, mtime, digest], hashing only the files whose size or mtime moved since db."""
+    state = {}
+    stale = []
+    for rel in rel_files:
+        stat = os.stat(os.path.join(tree, rel))
+        entry = db.get(rel)
+        if entry is not None and entry[0] == stat.st_size and entry[1] == stat.st_mtime:
+            state[rel] = entry
+        else:
+            state[rel] = [stat.st_size, stat.st_mtime, None]
+            stale.append(rel)
+
+    if len(stale) > 0:
+        for rel, digest in zip(stale, file_digests([os.path.join(tree, rel) for rel in stale], threads)):
+            state[rel][2] = digest
+
+    return state
+
+
+def clone_file(src_path, dst_path, link_mode='reflink'):
+    """Copies src_path to dst_path through a hardlink, a copy-on-write clone or a plain copy, returns the mode used."""
+    if link_mode == 'hardlink':
+        try:
+            os.link(src_path, dst_path)
+            return 'hardlink'
+        except OSError:
+            pass
+
+    if link_mode in ['reflink', 'hardlink']:
+        try:
+            if is_darwin():
+                libc = ctypes.CDLL('libc.dylib', use_errno=True)
+                if libc.clonefile(src_path, dst_path, 0) == 0:
+                    shutil.copystat(src_path, dst_path)
+                    return 'reflink'
+            elif not is_win():
+                import fcntl
+                with open(src_path, 'rb') as src_file:
+                    with open(dst_path, 'wb') as dst_file:
+                        fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+                shutil.copystat(src_path, dst_path)
+                return 'reflink'
+        except (IOError, OSError, AttributeError):
+            pass
+
+    if exists(dst_path):
+        os.remove(dst_path)
+    shutil.copyfile(src_path, dst_path)
+    shutil.copystat(src_path, dst_path)
+    return 'copy'
+
+
+def sync_file(src_path, dst_path, link_mode):
+    mkdir_for_file(dst_path)
+    temp_path = os.path.join(os.path.dirname(dst_path), '.' + os.path.basename(dst_path) + '.sync')
+    if exists(temp_path):
+        os.remove(temp_path)
+    mode = clone_file(src_path, temp_path, link_mode)
+    replace_file(temp_path, dst_path)
+    if PROFILE:
+        profile_count(bytes_written=os.path.getsize(dst_path), files=1)
+    detail('Copied => ' + dst_path, 'Copied')
+    return mode
+
+
+def sync_folder_db(src_path, dst_path, src_files, remove_diff=True, diff_predicate=None, remove_original=False,
+                   threads=0, link_mode='reflink'):
+    sync_dirs = [file for file in src_files if is_dir(file)]
+    rel_files = [os.path.relpath(file, src_path) for file in src_files if is_file(file)]
+    for file in src_files:
+        if not exists(file):
+            warning('Not found => ' + file)
+
+    dst_files = get_files(dst_path)
+    dst_rels = [os.path.relpath(file, dst_path) for file in dst_files]
+
+    src_state = tree_state(src_path, rel_files, load_sync_db(src_path), threads)
+    dst_state = tree_state(dst_path, dst_rels, load_sync_db(dst_path), threads)
+
+    src_rels = set(rel_files)
+    removed = []
+    if remove_diff:
+        for rel, file in zip(dst_rels, dst_files):
+            if rel not in src_rels and not is_file(os.path.join(src_path, rel)) and \
+                    (diff_predicate is None or diff_predicate(file)):
+                del_file(file)
+                removed.append(rel)
+        remove_empty_dirs(dst_path)
+    for rel in removed:
+        del dst_state[rel]
+
+    changed = [rel for rel in rel_files if rel not in dst_state or dst_state[rel][2] != src_state[rel][2]]
+
+    modes = parallel(sync_file, [[os.path.join(src_path, rel), os.path.join(dst_path, rel), link_mode] for rel in changed],
+                     threads, 'thread')
+
+    for rel in changed:
+        stat = os.stat(os.path.join(dst_path, rel))
+        dst_state[rel] = [stat.st_size, stat.st_mtime, src_state[rel][2]]
+
+    for file in sync_dirs:
+        copytree(file, join_path(dst_path, os.path.relpath(file, src_path)))
+
+    save_sync_db(src_path, src_state)
+    save_sync_db(dst_path, dst_state)
+
+    if remove_original:
+        for file in src_files:
+            del_file(file)
+
+    log_rollup()
+    copied_bytes = sum(src_state[rel][0] for rel in changed)
+    info('Synced => {}: {} of {} files copied ({}, {} cloned/linked), {} removed'.format(
+        dst_path, len(changed), len(rel_files), readable(copied_bytes),
+        len([mode for mode in modes if mode != 'copy']), len(removed)))
+
+    return src_files
+
+
+# File digests keyed by path => [size, mtime_ns, inode, sha1], persisted across runs
+DIGEST_CACHE = None
+DIGEST_CACHE_DIRTY = False
+
+
+def digest_cache_path():
+    return get_temp_path('digest_cache.json')
+
+
+def load_digest_cache():
+    global DIGEST_CACHE
+    if DIGEST_CACHE is None:
+        DIGEST_CACHE = {}
+        path = digest_cache_path()
+        if is_file(path):
+            try:
+                DIGEST_CACHE = json.loads(read(path))
+            except ValueError:
+                warning('Invalid digest cache => ' + path)
+        atexit.register(save_digest_cache)
+    return DIGEST_CACHE
+
+
+def save_digest_cache():
+    global DIGEST_CACHE_DIRTY
+    if DIGEST_CACHE is not None and DIGEST_CACHE_DIRTY:
+        write(digest_cache_path(), json.dumps(DIGEST_CACHE))
+        DIGEST_CACHE_DIRTY = False
+
+
+def digest_key(path):
+    stat = os.stat(path)
+    return [stat.st_size, getattr(stat, 'st_mtime_ns', int(stat.st_mtime * 1e9)), stat.st_ino]
+
+
+def cached_digest(path, key=None):
+    entry = load_digest_cache().get(path)
+    if entry is not None and entry[:3] == (key or digest_key(path)):
+        return entry[3]
+
+
+def file_digest(path, chunk_size=0x100000):
+    global DIGEST_CACHE_DIRTY
+
+    key = digest_key(path)
+    digest = cached_digest(path, key)
+    if digest is not None:
+        return digest
+
+    hasher = hashlib.new('sha1')
+    with open(path, 'rb') as input_file:
+        for chunk in iter(lambda: input_file.read(chunk_size), ''):
+            hasher.update(chunk)
+        profile_count(bytes_read=input_file.tell(), files=1)
+
+    digest = hasher.hexdigest()
+    load_digest_cache()[path] = key + [digest]
+    DIGEST_CACHE_DIRTY = True
+    return digest
+
+
+@profiled
+def file_digests(files, threads=0):
+    digests = [cached_digest(file) for file in files]
+    stale = [file for file, digest in zip(files, digests) if digest is None]
+
+    # hashlib releases the GIL while hashing, so threads scale over large files
+    hashed = dict(zip(stale, parallel_simple(file_digest, stale, threads, 'thread')))
+
+    return [digest if digest is not None else hashed[file] for file, digest in zip(files, digests)]
+
+
+def files_hash(files, threads=0):
+    """Hash over the cached per-file digests, cheap to recompute for files that did not change."""
+    hasher = hashlib.new('sha1')
+    for digest in file_digests(files, threads):
+        hasher.update(digest)
+    return hasher.hexdigest()
+
+
+@profiled
+def file_hash(files, chunk_size=0x100000):
     hasher = hashlib.new('sha1')
 
     for file in files:
         with open(file, 'rb') as input_file:
-            hasher.update(input_file.read())
+            for chunk in iter(lambda: input_file.read(chunk_size), ''):
+                hasher.update(chunk)
+            profile_count(bytes_read=input_file.tell(), files=1)
 
     return hasher.hexdigest()
 
 
-def zip_files(path, pack_size=4 * 0x100000, filenametag=''):
-    pwd = os.getcwd()
-    os.chdir(path)
+# Already compressed payloads are stored as is instead of being deflated again
+ZIP_STORE_EXTS = ['zip', 'apk', 'jar', 'gz', 'lz4', 'bundle', 'unity3d', 'ab', 'png', 'jpg', 'jpeg', 'mp3', 'ogg', 'mp4']
 
-    zip_packs = []
 
-    uncompressed_files = []
-    uncompressed_size = 0
+def zip_pack(path, archive_path, rel_files, store_exts=None):
+    import zipfile
+
+    store_exts = ZIP_STORE_EXTS if store_exts is None else store_exts
+    fd, temp_path = make_temp_file(archive_path)
+    os.close(fd)
+    try:
+        archive = zipfile.ZipFile(temp_path, 'w', zipfile.ZIP_DEFLATED, allowZip64=True)
+        try:
+            for rel in rel_files:
+                is_stored = (ext_name(rel) or '').lower() in store_exts
+                archive.write(os.path.join(path, rel), rel, zipfile.ZIP_STORED if is_stored else zipfile.ZIP_DEFLATED)
+        finally:
+            archive.close()
+        replace_file(temp_path, archive_path)
+    except:
+        if exists(temp_path):
+            os.remove(temp_path)
+        raise
 
-    for file in sorted(get_files(path), key=lambda a: file_size(a)):
-        uncompressed_size += file_size(file)
+    return archive_path
 
-        if uncompressed_size <= pack_size:
-            uncompressed_files.append(file)
+
+def pack_files(sizes, pack_size, packing='greedy', group_key=None, layout=None):
+    """Splits the files of sizes {file: size} into packs of at most pack_size bytes.
+
+    greedy fills packs in ascending size order. ffd is first-fit-decreasing over groups of
+    files sharing group_key(file), and seeds the packs from layout {file: pack index} so
+    unchanged files keep their pack across builds. Files larger than pack_size get their own pack."""
+    if packing == 'greedy':
+        zip_packs = []
+
+        uncompressed_files = []
+        uncompressed_size = 0
+
+        for file in sorted(sizes, key=lambda a: sizes[a]):
+            uncompressed_size += sizes[file]
+
+            if uncompressed_size <= pack_size:
+                uncompressed_files.append(file)
+            else:
+                zip_packs.append(uncompressed_files)
+                uncompressed_size = sizes[file]
+                uncompressed_files = [file]
+
+        zip_packs.append(uncompressed_files)
+        return [files for files in zip_packs if len(files) > 0]
+
+    packs = []
+    placed = set()
+
+    previous = {}
+    for file, index in (layout or {}).items():
+        if file in sizes:
+            previous.setdefault(index, []).append(file)
+    for index in sorted(previous):
+        pack = [0, []]
+        for file in sorted(previous[index], key=lambda a: (sizes[a], a)):
+            if pack[0] + sizes[file] <= pack_size or len(pack[1]) == 0:
+                pack[0] += sizes[file]
+                pack[1].append(file)
+                placed.add(file)
+        packs.append(pack)
+
+    groups = {}
+    for file in sizes:
+        if file not in placed:
+            groups.setdefault(group_key(file) if group_key is not None else file, []).append(file)
+
+    items = []
+    for files in groups.values():
+        total = sum(sizes[file] for file in files)
+        if total <= pack_size:
+            items.append((total, sorted(files)))
         else:
-            zip_packs.append(uncompressed_files)
-            uncompressed_size = file_size(file)
-            uncompressed_files = [file]
+            items += [(sizes[file], [file]) for file in files]
 
-    zip_packs.append(uncompressed_files)
+    for size, files in sorted(items, key=lambda a: (-a[0], a[1])):
+        target = None
+        for pack in packs:
+            if pack[0] + size <= pack_size:
+                target = pack
+                break
+        if target is None:
+            target = [0, []]
+            packs.append(target)
+        target[0] += size
+        target[1] += files
+
+    return [sorted(pack[1]) for pack in packs if len(pack[1]) > 0]
+
+
+@profiled
+def zip_files(path, pack_size=4 * 0x100000, filenametag='', store_exts=None, processes=0,
+              packing='greedy', group_key=None, layout_file=None):
+    path = real_path(path)
+    sizes = dict((file, file_size(file)) for file in get_files(path))
+
+    layout = None
+    if layout_file is not None and is_file(layout_file):
+        try:
+            layout = dict((join_path(path, rel, False), index) for rel, index in json.loads(read(layout_file)).items())
+        except ValueError:
+            warning('Invalid pack layout => ' + layout_file)
+
+    zip_packs = pack_files(sizes, pack_size, packing, group_key, layout)
 
-    zip_index = 0
+    fills = [sum(sizes[file] for file in files) / float(pack_size) for files in zip_packs]
+    if len(fills) > 0:
+        info('Packing {} files into {} packs, fill ratio avg {:.0%} min {:.0%}'.format(
+            len(sizes), len(zip_packs), sum(fills) / len(fills), min(fills)))
+
+    if layout_file is not None:
+        write(layout_file, json.dumps(dict((rel_path(file, path), index)
+                                           for index, files in enumerate(zip_packs) for file in files),
+                                      indent=4, sort_keys=True))
+
+    digests = dict(zip(sizes.keys(), file_digests(sizes.keys())))
     timestamp = int(time.time())
-    for uncompressed_files in zip_packs:
-        if len(uncompressed_files) > 0:
-            list_file = get_temp_path('pack_list')
-            write(list_file, '\n'.join([rel_path(file, path) for file in uncompressed_files]))            
-            execute('zip', '-q', 'update_{0}_{1}_{2}_{3}'.format(timestamp, filenametag, zip_index, file_hash(uncompressed_files)), '-@', '<', list_file)
-            zip_index += 1
+    args_list = []
+    for zip_index, uncompressed_files in enumerate(zip_packs):
+        hasher = hashlib.new('sha1')
+        for file in uncompressed_files:
+            hasher.update(digests[file])
+        archive_name = 'update_{0}_{1}_{2}_{3}.zip'.format(timestamp, filenametag, zip_index, hasher.hexdigest())
+        args_list.append([path, os.path.join(path, archive_name), [rel_path(file, path) for file in uncompressed_files], store_exts])
 
-    os.chdir(pwd)
+    # Packs are written by worker processes, only their inputs are accounted here
+    profile_count(bytes_read=sum(sizes.values()), files=len(sizes))
+    for archive_path in parallel(zip_pack, args_list, processes):
+        info('Packed => ' + archive_path)
 
 
 def mount(mount_info):
@@ -1083,32 +2062,168 @@ def readable(size):
 #         meta_output.write(json.dumps(dict, sort_keys=True, indent=4))
 
 
+POOLS = {}
+# Calls currently waiting on each pool, and pools replaced after a failure that end with their last user
+POOL_USERS = {}
+RETIRED_POOLS = set()
+POOL_LOCK = threading.Lock()
+POOL_STATE = threading.local()
+PROGRESS_INTERVAL = 2.0 #seconds
+
+
 def pool_function(args):
     try:
-        args[0](*args[1])
+        return args[0](*args[1])
     except Exception as e:
         raise
 
 
-def parallel_simple(func, args_list, threads=0):
-    parallel(func, [[args] for args in args_list], threads)
+def run_chunk(chunk):
+    func, tasks = chunk
+    return [(index, pool_function([func, args])) for index, args in tasks]
 
 
-def parallel(func, args_list, threads=0):
-    if is_win():
-        for args in args_list:
-            apply(func, args)
+def pool_chunk(chunk):
+    # Process workers end through os._exit, their buffered log lines would be lost
+    try:
+        return run_chunk(chunk)
+    finally:
+        flush_log()
+
+
+def process_pool_init():
+    # Workers are forked with whatever locks other threads held at that moment
+    global POOL_LOCK
+    POOL_LOCK = threading.Lock()
+    own_log_buffer()
+    POOL_STATE.worker = True
+
+
+def thread_pool_chunk(chunk):
+    # Marks pool threads, so a task calling parallel again runs inline instead of waiting on its own pool
+    POOL_STATE.worker = True
+    return run_chunk(chunk)
+
+
+def get_pool(mode='process', size=0, use=False):
+    """Pools are created on first use, kept for later calls and shut down at exit.
+
+    Process workers are forked once, so they see module state and environment as of their creation:
+    pass anything that changes later as arguments. With use, the caller must hand it back to release_pool."""
+    key = (mode, size or multiprocessing.cpu_count())
+    with POOL_LOCK:
+        pool = POOLS.get(key)
+        if pool is not None and use:
+            POOL_USERS[pool] = POOL_USERS.get(pool, 0) + 1
+    if pool is not None:
+        return pool
+
+    # Created outside POOL_LOCK, forked workers must not start with it held
+    if mode == 'thread':
+        from multiprocessing.pool import ThreadPool
+        created = ThreadPool(key[1])
     else:
-        if threads == 0:
-            threads = multiprocessing.cpu_count()
+        # Workers would otherwise inherit and write again the buffered log lines
+        flush_log()
+        created = multiprocessing.Pool(key[1], process_pool_init)
+
+    with POOL_LOCK:
+        pool = POOLS.get(key)
+        if pool is None:
+            if len(POOLS) == 0:
+                atexit.register(shutdown_pools)
+            pool = POOLS[key] = created
+        if use:
+            POOL_USERS[pool] = POOL_USERS.get(pool, 0) + 1
+    if pool is not created:
+        # Another call published its pool first
+        created.terminate()
+        created.join()
+    return pool
+
+
+def release_pool(mode, size, pool, failed=False):
+    # A failed call leaves its remaining tasks queued: later calls get a new pool, while the old one
+    # keeps serving the calls already waiting on it and is terminated once the last of them is done
+    with POOL_LOCK:
+        POOL_USERS[pool] -= 1
+        if failed and POOLS.get((mode, size)) is pool:
+            del POOLS[(mode, size)]
+            RETIRED_POOLS.add(pool)
+        finished = pool in RETIRED_POOLS and POOL_USERS[pool] == 0
+        if POOL_USERS[pool] == 0:
+            del POOL_USERS[pool]
+        if finished:
+            RETIRED_POOLS.discard(pool)
+    if finished:
+        pool.terminate()
+        pool.join()
+
+
+def shutdown_pools(terminate=False):
+    with POOL_LOCK:
+        pools = POOLS.values()
+        POOLS.clear()
+    for pool in pools:
+        if terminate:
+            pool.terminate()
+        else:
+            pool.close()
+        pool.join()
 
-        pool = multiprocessing.Pool(threads)
-        p = pool.map_async(pool_function, [[func, args] for args in args_list])
 
-        try:
-            p.get(0xFFFF)
-        except Exception as e:
-            raise e
+def parallel_simple(func, args_list, threads=0, mode='process', **options):
+    return parallel(func, [[args] for args in args_list], threads, mode, **options)
+
+
+def parallel(func, args_list, threads=0, mode='process', chunksize=None, progress=None):
+    """Runs func over args_list on a shared pool, returns the results in the order of args_list.
+
+    mode 'thread' suits I/O bound work such as copying or hashing, 'process' needs func to be picklable
+    and runs on threads on Windows. Progress is logged when asked or once a run takes long."""
+    if len(args_list) == 0:
+        return []
+    if getattr(POOL_STATE, 'worker', False) or (len(args_list) == 1 and progress is None):
+        return [apply(func, args) for args in args_list]
+
+    if is_win():
+        mode = 'thread'
+    size = threads or multiprocessing.cpu_count()
+    if chunksize is None:
+        # As Pool.map does: about four chunks per worker, so stragglers are balanced out
+        chunksize, extra = divmod(len(args_list), size * 4)
+        chunksize += 1 if extra else 0
+
+    flush_log()
+    pool = get_pool(mode, size, True)
+    results = [None] * len(args_list)
+    # Chunks are built here, imap_unordered only supports a timeout on its iterator for a chunksize of 1
+    tasks = list(enumerate(args_list))
+    chunks = [[func, tasks[i:i + chunksize]] for i in range(0, len(tasks), chunksize)]
+    iterator = pool.imap_unordered(thread_pool_chunk if mode == 'thread' else pool_chunk, chunks)
+
+    start_time = time.time()
+    report_time = start_time + (0 if progress else PROGRESS_INTERVAL)
+    done = 0
+    try:
+        while done < len(tasks):
+            try:
+                # Wait in short slices, so KeyboardInterrupt still reaches the main thread
+                for index, result in iterator.next(1):
+                    results[index] = result
+                    done += 1
+            except multiprocessing.TimeoutError:
+                pass
+
+            if progress is not False and time.time() >= report_time:
+                info('Progress => {}: {}/{} {:.1f} seconds'.format(func.__name__, done, len(tasks), time.time() - start_time))
+                report_time = time.time() + PROGRESS_INTERVAL
+    except BaseException:
+        release_pool(mode, size, pool, True)
+        raise
+
+    release_pool(mode, size, pool)
+    return results
 
 
 def is_same_file(path_array):
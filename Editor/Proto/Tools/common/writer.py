@@ -1,4 +1,19 @@
 from common import utility as u
+import hashlib
+import os
+import time
+
+# Buffered text beyond this many bytes is spilled to a temp file beside the output
+SPILL_SIZE = 0x100000
+INDENT_PREFIXES = {}
+
+
+def indent_prefix(indent, using_tab):
+    key = (indent, using_tab)
+    prefix = INDENT_PREFIXES.get(key)
+    if prefix is None:
+        prefix = INDENT_PREFIXES[key] = '\t' * (indent / 4) if using_tab else ' ' * indent
+    return prefix
 
 
 class writer:
@@ -7,9 +22,14 @@ class writer:
         self.path = rel_path
         self.indent = 0
         self.content = []
+        self.content_size = 0
+        self.total_size = 0
+        self.hasher = hashlib.new('sha1')
+        self.spill_file = None
+        self.spill_path = None
         self.using_tab = using_tab
         if generate_header:
-            self.wl(comment_prefix + ' THIS FILE IS AUTOMATIC GENERATED BY REFLECT TOOL')            
+            self.wl(comment_prefix + ' THIS FILE IS AUTOMATIC GENERATED BY REFLECT TOOL')
             self.wl(comment_prefix + ' DO NOT MODIFY THIS FILE MANUALLY')
             self.wl()
 
@@ -19,22 +39,122 @@ class writer:
     def __exit__(self, exc_type, exc_value, traceback):
         self.flush()
 
-    def w(self, txt='', indent=0):
+    def put(self, text, indent):
         if indent < 0:
             self.indent += indent
-        if self.using_tab:
-            self.content.append('\t' * (self.indent / 4) + str(txt))
-        else:
-            self.content.append(' ' * self.indent + str(txt))
+        # indent is public and may be changed directly, the prefix is looked up for every line
+        line = indent_prefix(self.indent, self.using_tab) + text
+        self.content.append(line)
+        self.content_size += len(line)
+        if self.content_size >= SPILL_SIZE:
+            self.spill()
         if indent > 0:
             self.indent += indent
 
+    def w(self, txt='', indent=0):
+        self.put(str(txt), indent)
+
     def wl(self, txt='', indent=0):
-        self.w(str(txt) + '\n', indent)
+        self.put(str(txt) + '\n', indent)
 
     def wfl(self, txt='', *args):
-        self.wl(str(txt).format(*args))
+        txt = str(txt)
+        # Without arguments or braces format would return txt unchanged
+        if len(args) > 0 or '{' in txt or '}' in txt:
+            txt = txt.format(*args)
+        self.put(txt + '\n', 0)
+
+    def take(self):
+        block = ''.join(self.content)
+        self.content = []
+        self.content_size = 0
+        self.total_size += len(block)
+        self.hasher.update(block)
+        return block
+
+    def spill(self):
+        if self.spill_file is None:
+            u.mkdir_for_file(self.path)
+            fd, self.spill_path = u.make_temp_file(self.path)
+            self.spill_file = os.fdopen(fd, 'wb')
+        self.spill_file.write(self.take())
 
     def flush(self):
-        if u.write(self.path, ''.join(self.content)):
+        """Small outputs stay in memory and can be flushed again, a spilled one is complete after its flush."""
+        if self.spill_path is None:
+            updated = u.write(self.path, ''.join(self.content))
+        elif self.spill_file is None:
+            return False
+        else:
+            self.spill()
+            self.spill_file.close()
+            self.spill_file = None
+
+            digest = self.hasher.hexdigest()
+            updated = not u.exists(self.path) or u.is_digest_changed(self.path, self.total_size, digest)
+            if updated:
+                u.commit_file(self.spill_path, self.path, digest)
+                u.profile_count(bytes_written=self.total_size, files=1)
+            else:
+                os.remove(self.spill_path)
+
+        if updated:
             u.log('Reflect => ' + self.path)
+        return updated
+
+    def collect(self):
+        """For session: returns the content when it differs from the file on disk, None otherwise."""
+        content = ''.join(self.content)
+        if not u.exists(self.path) or u.is_content_changed(self.path, content):
+            return content
+        return None
+
+
+def run_job(path, func, args, options):
+    output = writer(path, **options)
+    func(output, *args)
+    if output.spill_path is not None:
+        # Too large to send back whole, the worker commits it itself
+        return path, None, output.flush()
+    return path, output.collect(), False
+
+
+class session:
+    """Generates many files at once: every job fills the writer of one output on a process pool.
+
+    Jobs are func(writer, *args) and must be picklable. Changed outputs are written by the caller's
+    process after creating their folders once, followed by a single summary line."""
+
+    def __init__(self, name='Reflect', processes=0, mode='process'):
+        self.name = name
+        self.processes = processes
+        self.mode = mode
+        self.jobs = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.run()
+
+    def add(self, path, func, *args, **options):
+        self.jobs.append([path, func, args, options])
+
+    def run(self):
+        start_time = time.time()
+        results = u.parallel(run_job, self.jobs, self.processes, self.mode)
+        self.jobs = []
+
+        changed = [(path, content) for path, content, _ in results if content is not None]
+        for folder in sorted(set(os.path.dirname(path) for path, _ in changed)):
+            if len(folder) > 0 and not os.path.isdir(folder):
+                os.makedirs(folder)
+        u.parallel(u.write, [[path, content, True] for path, content in changed], self.processes, 'thread')
+
+        for path, _ in changed:
+            u.detail('Reflect => ' + path, 'Reflected')
+        updated = [path for path, _ in changed] + [path for path, _, committed in results if committed]
+        u.info('{} => {} of {} files changed {:.2f} seconds'.format(
+            self.name, len(updated), len(results), time.time() - start_time))
+        return updated
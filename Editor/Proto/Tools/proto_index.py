@@ -0,0 +1,163 @@
+#!/usr/bin/python
+
+from common import utility as u
+import hashlib
+import json
+import os
+import re
+
+INDEX_VERSION = 1
+TOKEN_PATTERN = re.compile(r'"(?:\\.|[^"\\])*"|//[^\n]*|/\*.*?\*/', re.S)
+IMPORT_PATTERN = re.compile(r'^\s*import\s+(?:public\s+|weak\s+)?"([^"]+)"\s*;', re.M)
+PACKAGE_PATTERN = re.compile(r'^\s*package\s+([\w.]+)\s*;', re.M)
+DECLARE_PATTERN = re.compile(r'\b(message|enum)\s+(\w+)\s*\{')
+
+
+def strip_comments(content):
+    return TOKEN_PATTERN.sub(lambda m: m.group(0) if m.group(0)[0] == '"' else ' ', content)
+
+
+def parse_proto(path):
+    with open(path, 'rb') as file:
+        content = file.read()
+
+    source = strip_comments(content)
+    package = PACKAGE_PATTERN.search(source)
+    declares = DECLARE_PATTERN.findall(source)
+
+    return {
+        'sha1': hashlib.sha1(content).hexdigest(),
+        'package': package.group(1) if package else '',
+        'imports': IMPORT_PATTERN.findall(source),
+        'messages': [name for kind, name in declares if kind == 'message'],
+        'enums': [name for kind, name in declares if kind == 'enum'],
+    }
+
+
+class ProtoIndex:
+    """Import graph of the .proto files under the search paths, persisted and refreshed by mtime/size."""
+
+    def __init__(self, search_path, cache_path=None):
+        self.search_path = [u.real_path(p) for p in search_path if u.exists(p)]
+        self.cache_path = cache_path or u.get_temp_path('proto_index.json')
+        self.entries = {}
+        self.names = {}
+        self.reverse = {}
+        self.load()
+
+    def load(self):
+        if u.is_file(self.cache_path):
+            try:
+                cache = json.loads(u.read(self.cache_path))
+                if cache.get('version') == INDEX_VERSION:
+                    self.entries = cache.get('entries', {})
+            except ValueError:
+                u.warning('Invalid proto index => ' + self.cache_path)
+
+    def save(self):
+        u.write(self.cache_path, json.dumps({'version': INDEX_VERSION, 'entries': self.entries}, sort_keys=True))
+
+    def refresh(self):
+        entries = {}
+        changed = []
+        self.names = {}
+
+        for root in self.search_path:
+            for path in u.get_files(root, ['proto']):
+                self.names.setdefault(u.rel_path(path, root).replace(os.sep, '/'), path)
+                if path in entries:
+                    continue
+
+                stat = os.stat(path)
+                stamp = [stat.st_size, stat.st_mtime]
+                entry = self.entries.get(path)
+                if entry is None or entry['stamp'] != stamp:
+                    entry = parse_proto(path)
+                    entry['stamp'] = stamp
+                    changed.append(path)
+                entries[path] = entry
+
+        removed = [path for path in self.entries if path not in entries]
+        self.entries = entries
+
+        self.reverse = {}
+        for path in self.entries:
+            for dependency in self.imports(path):
+                self.reverse.setdefault(dependency, set()).add(path)
+
+        if len(changed) > 0 or len(removed) > 0:
+            self.save()
+
+        return changed + removed
+
+    def resolve(self, name):
+        return self.names.get(name)
+
+    def imports(self, path):
+        entry = self.entries.get(path)
+        if entry is None:
+            return []
+        return [p for p in (self.resolve(name) for name in entry['imports']) if p is not None]
+
+    def dependents(self, path):
+        return sorted(self.reverse.get(path, []))
+
+    def transitive_imports(self, path):
+        result = set()
+        pending = [path]
+        while len(pending) > 0:
+            for dependency in self.imports(pending.pop()):
+                if dependency not in result:
+                    result.add(dependency)
+                    pending.append(dependency)
+        result.discard(path)
+        return result
+
+    def affected(self, paths):
+        result = set(paths)
+        pending = list(paths)
+        while len(pending) > 0:
+            for dependent in self.reverse.get(pending.pop(), []):
+                if dependent not in result:
+                    result.add(dependent)
+                    pending.append(dependent)
+        return result
+
+    def fingerprint(self, path, cache=None, visiting=None):
+        cache = cache if cache is not None else {}
+        if path in cache:
+            return cache[path]
+
+        visiting = visiting or set()
+        visiting.add(path)
+
+        entry = self.entries.get(path)
+        hasher = hashlib.new('sha1')
+        hasher.update(entry['sha1'] if entry is not None else path)
+        for name in entry['imports'] if entry is not None else []:
+            hasher.update(name)
+            dependency = self.resolve(name)
+            if dependency is not None and dependency not in visiting:
+                hasher.update(self.fingerprint(dependency, cache, visiting))
+
+        visiting.discard(path)
+        cache[path] = hasher.hexdigest()
+        return cache[path]
+
+    def symbols(self, path):
+        entry = self.entries.get(path, {})
+        package = entry.get('package', '')
+        prefix = package + '.' if len(package) > 0 else ''
+        return [prefix + name for name in entry.get('messages', []) + entry.get('enums', [])]
+
+
+def main():
+    index = ProtoIndex(u.get_args() or [u.get_res('../')])
+    changed = index.refresh()
+    u.info('Indexed {} protos, {} changed'.format(len(index.entries), len(changed)))
+    for path in sorted(index.entries):
+        u.log(path + ': ' + ', '.join(index.dependents(path)))
+
+
+if __name__ == '__main__':
+    main()
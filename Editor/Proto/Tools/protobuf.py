@@ -3,6 +3,10 @@
 from common import utility as u
 import re
 import time,os
+import json
+from proto_index import ProtoIndex
+
+MANIFEST_NAME = '.protoc_manifest'
 
 def get_bin():    
     return u.get_bin('protoc')
@@ -15,51 +19,282 @@ def get_protofiles(input_path):
     return proto_files
 
 
-def make_args(input_path, search_path, purpose):    
-    proto_files = get_protofiles(input_path)
+def make_options():
+    args = ''        
+    args = args + '--strip_source_info '
+    args = args + '--ignore_options=urls:view:comment:fc:ec:evc '
+    if u.is_ci_mode():
+        args = args + '--ignore_options=NOAH.Proto.enum_tooltip:NOAH.Proto.field_tooltip '
+    return args
+
+
+def make_args(input_path, search_path, purpose, proto_files=None, response_name='cmd_args'):    
+    if proto_files is None:
+        proto_files = get_protofiles(input_path)
 
     if len(proto_files) > 0:
-        additional_path = u.get_temp_path("cmd_args")
+        additional_path = u.get_temp_path(response_name)
         u.write(additional_path, "\n".join(proto_files))
-        args = ''        
-        args = args + '--strip_source_info '
-        args = args + '--ignore_options=urls:view:comment:fc:ec:evc '
-        if u.is_ci_mode():
-            args = args + '--ignore_options=NOAH.Proto.enum_tooltip:NOAH.Proto.field_tooltip '
+        args = make_options()
         args = args + ' '.join(['--proto_path=' + p for p in search_path if u.exists(p)]) + ' @' + additional_path
         
         return args
     else:
         return None, None
 
-def generate_descriptor(input_path, pb_out, search_path):
-    args = make_args(input_path, search_path, 'descriptor')   
-    u.execute(get_bin(), '--include_source_info', '-o ' + pb_out, args)
 
+# Sharded compilation
+def partition_protofiles(proto_files, proto_index, jobs):
+    index = dict((f, i) for i, f in enumerate(proto_files))
+    parent = range(len(proto_files))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for i, proto_file in enumerate(proto_files):
+        for dependency in proto_index.imports(proto_file):
+            if dependency in index:
+                parent[find(i)] = find(index[dependency])
+
+    components = {}
+    for i in range(len(proto_files)):
+        components.setdefault(find(i), []).append(i)
+
+    # Largest component first into the lightest shard, keeping the serial order inside each shard
+    shards = [[0, []] for _ in range(min(jobs, len(components)))]
+    weight = lambda c: sum(u.file_size(proto_files[i]) for i in c)
+    for component in sorted(components.values(), key=weight, reverse=True):
+        shard = min(shards, key=lambda s: s[0])
+        shard[0] += weight(component)
+        shard[1] += component
+
+    return [[proto_files[i] for i in sorted(s[1])] for s in shards if len(s[1]) > 0]
+
+
+def protoc_shard(*args):
+    result = u.execute(get_bin(), *args, ignore_error=True)
+    return result.code, result.error
+
+
+def run_protoc(out_args, input_path, search_path, purpose, proto_files, jobs=1):
+    shards = [proto_files]
+    if jobs > 1 and len(proto_files) > 1:
+        proto_index = ProtoIndex(search_path)
+        proto_index.refresh()
+        shards = partition_protofiles(proto_files, proto_index, jobs)
+
+    if len(shards) <= 1:
+        if callable(out_args):
+            out_args = out_args(None)
+        u.execute(get_bin(), out_args, make_args(input_path, search_path, purpose, proto_files))
+        return shards
+
+    if callable(out_args):
+        shard_out_args = [out_args(i) for i in range(len(shards))]
+    else:
+        shard_out_args = [out_args] * len(shards)
+
+    args_list = [[shard_out_args[i], make_args(input_path, search_path, purpose, shard, 'cmd_args_{}'.format(i))]
+                 for i, shard in enumerate(shards)]
+    u.info('Protoc sharded => {} files in {} shards'.format(len(proto_files), len(shards)))
+
+    for code, message in u.parallel(protoc_shard, args_list, jobs):
+        if code != 0:
+            u.error('Protoc failed code: ' + str(code) + ' message: ' + str(message))
+            u.abort()
+
+    return shards
+
+
+def split_descriptor_set(data):
+    records = []
+    pos = 0
+    while pos < len(data):
+        start = pos
+        if data[pos] != '\x0a':
+            u.error('Unexpected field in descriptor set at offset ' + str(pos))
+            u.abort()
+        pos += 1
+        length = 0
+        shift = 0
+        while True:
+            byte = ord(data[pos])
+            pos += 1
+            length |= (byte & 0x7F) << shift
+            shift += 7
+            if not byte & 0x80:
+                break
+        pos += length
+        records.append(data[start:pos])
+    return records
+
+
+# Incremental compilation
+def get_protoc_version(manifest):
+    stat = os.stat(get_bin())
+    stamp = [stat.st_size, int(stat.st_mtime)]
+    if manifest.get('protoc_stamp') == stamp:
+        return manifest.get('protoc'), stamp
+    return u.execute(get_bin(), '--version', verbose=False).out, stamp
+
+
+def load_manifest(path):
+    if u.is_file(path):
+        try:
+            return json.loads(u.read(path))
+        except ValueError:
+            u.warning('Invalid protoc manifest => ' + path)
+    return {}
+
+
+def make_manifest(proto_files, search_path, proto_index, old_manifest):
+    protoc_version, protoc_stamp = get_protoc_version(old_manifest)
+    cache = {}
+    return {
+        'protoc': protoc_version,
+        'protoc_stamp': protoc_stamp,
+        'options': make_options() + ' '.join(search_path),
+        'files': dict((f, proto_index.fingerprint(f, cache)) for f in proto_files),
+    }
+
+
+def save_manifest(path, manifest):
+    u.write(path, json.dumps(manifest, indent=4, sort_keys=True))
+
+
+def list_outputs(out_path, exts):
+    return sorted(u.rel_path(f, out_path) for f in u.get_files(out_path, exts))
+
+
+def check_manifest(proto_files, input_path, search_path, manifest_path, out_path=None):
+    """Return the protos to rebuild: the changed ones plus everything importing them, or all on a config change.
+
+    With out_path, everything is rebuilt as well when an output recorded in the manifest has gone missing."""
+    proto_index = ProtoIndex(search_path + [p for p in input_path if p not in search_path])
+    proto_index.refresh()
+
+    old_manifest = load_manifest(manifest_path)
+    manifest = make_manifest(proto_files, search_path, proto_index, old_manifest)
+    old_files = old_manifest.get('files', {})
+
+    if old_manifest.get('protoc') != manifest['protoc'] or \
+            old_manifest.get('options') != manifest['options'] or \
+            set(old_files.keys()) != set(manifest['files'].keys()):
+        return proto_files, manifest
+    if out_path is not None:
+        outputs = old_manifest.get('outputs')
+        if outputs is None or not all(u.is_file(u.join_path(out_path, f)) for f in outputs):
+            u.info('Outputs missing => ' + out_path)
+            return proto_files, manifest
 
-def generate_python(input_path, python_out, search_path):
-    args = make_args(input_path, search_path, 'python')   
-    u.clear_dir(python_out)
-    u.execute(get_bin(), '--python_out=' + python_out, args)
+    changed = [f for f in proto_files if old_files[f] != manifest['files'][f]]
+    affected = proto_index.affected(changed)
+    return [f for f in proto_files if f in affected], manifest
+
+
+def touched_files(files, start_time):
+    # protoc only rewrites the outputs of the protos it was given
+    return [f for f in files if os.path.getmtime(f) >= start_time - 1]
+
+
+def generate_descriptor(input_path, pb_out, search_path, incremental=False, jobs=1, include_imports=False):
+    proto_files = get_protofiles(input_path)
+    manifest_path = pb_out + MANIFEST_NAME
+    if incremental:
+        stale_files, manifest = check_manifest(proto_files, input_path, search_path, manifest_path)
+        if len(stale_files) == 0 and u.is_file(pb_out):
+            u.info('Up to date => ' + pb_out)
+            return
+
+    # Imported files are emitted ahead of their importers, so such sets can not be restitched from shards
+    out_args = '--include_source_info ' + ('--include_imports ' if include_imports else '')
+    shard_path = lambda i: pb_out if i is None else pb_out + '.shard{}'.format(i)
+    shards = run_protoc(lambda i: out_args + '-o ' + shard_path(i),
+                        input_path, search_path, 'descriptor', proto_files, 1 if include_imports else jobs)
+
+    if len(shards) > 1:
+        # A FileDescriptorSet is a plain list of files, so shard outputs are restitched in the serial order
+        records = {}
+        for i, shard in enumerate(shards):
+            with open(shard_path(i), 'rb') as file:
+                shard_records = split_descriptor_set(file.read())
+            os.remove(shard_path(i))
+            if len(shard_records) != len(shard):
+                u.error('Descriptor shard mismatch => ' + shard_path(i))
+                u.abort()
+            records.update(zip(shard, shard_records))
+        u.write(pb_out, ''.join(records[f] for f in proto_files))
+
+    if incremental:
+        save_manifest(manifest_path, manifest)
+
+
+def finish_python(python_out, files):
     u.touch(u.join_path(python_out, '__init__.py'))
 
     # HACK: Temporary fix for windows since it would cause error if a proto file is too large
-    for file in u.get_files(python_out, ['py']):
-        content = u.read(file)
-        content = content.replace('serialized_options=None', 'serialized_options=\'\'')
-        u.write(file, content)
+    replaced = u.parallel(u.replace_in_file, [[f, 'serialized_options=None', 'serialized_options=\'\''] for f in files])
+    u.info('Patched serialized_options => {} of {} files'.format(len([r for r in replaced if r]), len(files)))
+
+
+def generate_python(input_path, python_out, search_path, incremental=False, jobs=1):
+    proto_files = get_protofiles(input_path)
+    stale_files = proto_files
+    manifest_path = u.join_path(python_out, MANIFEST_NAME)
+    if incremental:
+        stale_files, manifest = check_manifest(proto_files, input_path, search_path, manifest_path, python_out)
+        if len(stale_files) == 0:
+            u.info('Up to date => ' + python_out)
+            return
+
+    start_time = time.time()
+    is_full = len(stale_files) == len(proto_files)
+    if is_full:
+        u.clear_dir(python_out)
+    run_protoc('--python_out=' + python_out, input_path, search_path, 'python', stale_files, jobs)
+    out_files = u.get_files(python_out, ['py'])
+    finish_python(python_out, out_files if is_full else touched_files(out_files, start_time))
 
+    if incremental:
+        manifest['outputs'] = list_outputs(python_out, ['py'])
+        save_manifest(manifest_path, manifest)
 
 
-def generate_csharp(input_path, csharp_out, search_path):
-    args = make_args(input_path, search_path, 'csharp')   
-    u.del_files(u.get_files(csharp_out, ['cs']))        
-    u.execute(get_bin(), '--csharp_out=' + csharp_out, args)
 
-    for file in u.get_files(csharp_out, ['cs']):
+def finish_csharp(csharp_out, files):
+    for file in files:
         u.normalize_eol(file)
 
 
+def generate_csharp(input_path, csharp_out, search_path, incremental=False, jobs=1):
+    proto_files = get_protofiles(input_path)
+    stale_files = proto_files
+    manifest_path = u.join_path(csharp_out, MANIFEST_NAME)
+    if incremental:
+        stale_files, manifest = check_manifest(proto_files, input_path, search_path, manifest_path, csharp_out)
+        if len(stale_files) == 0:
+            u.info('Up to date => ' + csharp_out)
+            return
+
+    start_time = time.time()
+    is_full = len(stale_files) == len(proto_files)
+    if is_full:
+        u.del_files(u.get_files(csharp_out, ['cs']))        
+    else:
+        u.info('Protoc rebuilding {} of {} files'.format(len(stale_files), len(proto_files)))
+    run_protoc('--csharp_out=' + csharp_out, input_path, search_path, 'csharp', stale_files, jobs)
+
+    out_files = u.get_files(csharp_out, ['cs'])
+    finish_csharp(csharp_out, out_files if is_full else touched_files(out_files, start_time))
+
+    if incremental:
+        manifest['outputs'] = list_outputs(csharp_out, ['cs'])
+        save_manifest(manifest_path, manifest)
+
+
 
 def generate_go(input_path, go_out, search_path):
     args = make_args(input_path, search_path, 'go')   
@@ -70,8 +305,59 @@ def generate_go(input_path, go_out, search_path):
                 '-I ' + input_path[0],
                 input_path[0] + '/*.proto')
 
+
+
+# Batched generation
+TARGETS = {
+    'descriptor': ('--include_source_info -o ', None, None),
+    'python': ('--python_out=', u.clear_dir, finish_python),
+    'csharp': ('--csharp_out=', lambda out: u.del_files(u.get_files(out, ['cs'])), finish_csharp),
+    'go': ('--go_out=', lambda out: u.del_files(u.get_files(out, ['go'])), None),
+}
+TARGET_EXTS = {'python': ['py'], 'csharp': ['cs'], 'go': ['go']}
+
+
+def proto_name(proto_file, search_path):
+    for path in search_path:
+        path = u.real_path(path)
+        if proto_file.startswith(path + os.sep):
+            return u.rel_path(proto_file, path).replace(os.sep, '/')
+    return proto_file
+
+
+def generate_all(input_path, targets, search_path, from_descriptor=False):
+    """Emit every (language, out) target from a single protoc run, optionally off the cached descriptor set."""
+    proto_files = get_protofiles(input_path)
+    if len(proto_files) == 0:
+        return
+
+    for language, out in targets:
+        prepare = TARGETS[language][1]
+        if language != 'descriptor':
+            u.mkdir(out)
+        if prepare is not None:
+            prepare(out)
+
+    out_args = ' '.join(TARGETS[language][0] + out for language, out in targets)
+
+    if from_descriptor:
+        descriptor_set = u.get_temp_path('protoc_descriptor_set.pb')
+        generate_descriptor(input_path, descriptor_set, search_path, incremental=True, include_imports=True)
+        response_path = u.get_temp_path('cmd_args')
+        u.write(response_path, '\n'.join(proto_name(f, search_path) for f in proto_files))
+        args = make_options() + '--descriptor_set_in=' + descriptor_set + ' @' + response_path
+    else:
+        args = make_args(input_path, search_path, 'all', proto_files)
+
+    u.execute(get_bin(), out_args, args)
+
+    for language, out in targets:
+        finish = TARGETS[language][2]
+        if finish is not None:
+            finish(out, u.get_files(out, TARGET_EXTS[language]))
+
                     
-def do_compile():
+def do_compile(incremental=True, jobs=1):
     # for project
     proj_input_path = u.get_res('../')
     print(proj_input_path)
@@ -80,11 +366,11 @@ def do_compile():
     proj_csharp_out = u.get_res('../Generated/')
     if not u.exists(proj_csharp_out):
         u.mkdir(proj_csharp_out)
-    generate_csharp([proj_input_path], proj_csharp_out, [proj_input_path])
+    generate_csharp([proj_input_path], proj_csharp_out, [proj_input_path], incremental, jobs)
 
 
 def main():
-    do_compile()
+    do_compile(u.get_argx('full') is None, int(u.get_argx('jobs', 1)))
 
 
 if __name__ == '__main__':